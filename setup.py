@@ -1,17 +1,34 @@
 #!/usr/bin/env python
 
 import os
+import sys
 
 from setuptools import setup
+from setuptools.command.build_py import build_py
 
 readme_file = 'README.rst'
 with open(os.path.join(os.path.dirname(__file__), readme_file)) as f:
     long_description = f.read()
 
+
+class BuildPy(build_py):
+    """ Leave out the asyncio front end before Python 3.6, which cannot
+        compile it.
+    """
+
+    def find_package_modules(self, package, package_dir):
+        modules = build_py.find_package_modules(self, package, package_dir)
+        if sys.version_info < (3, 6):
+            modules = [module for module in modules
+                       if (module[0], module[1]) != ('smbfs', 'aio')]
+        return modules
+
+
 setup(
     name='smbfs',
     version='0.2',
     packages=['smbfs'],
+    cmdclass={'build_py': BuildPy},
     description='A PyFilesystem backend for SMB shares.',
     long_description=long_description,
     install_requires=(
@@ -30,6 +47,8 @@ setup(
         'Intended Audience :: Developers',
         'Operating System :: OS Independent',
         'Programming Language :: Python',
+        'Programming Language :: Python :: 2',
+        'Programming Language :: Python :: 3',
         'Topic :: Software Development :: Libraries :: Python Modules',
         'License :: OSI Approved :: BSD License',
     )
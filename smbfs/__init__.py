@@ -1,18 +1,44 @@
 """ Filesystem to access SMB servers.
 """
+import bisect
 import datetime
 import errno
+import fnmatch
+import gzip
+import hashlib
+import io
+import os
 import random
+import re
 import socket
 import stat
 import string
-
+import tempfile
+import threading
+import time
+
+try:
+    from collections.abc import Mapping
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import Mapping
+    from collections import MutableMapping
+from collections import OrderedDict
+from collections import deque
+from contextlib import contextmanager
 from functools import wraps
+from multiprocessing.pool import ThreadPool
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 from smb.SMBConnection import SMBConnection
 from smb.base import NotConnectedError
 from smb.base import NotReadyError
 from smb.base import OperationFailure
+from smb.base import SMBTimeout
 
 from fs import _thread_synchronize_default
 from fs import iotools
@@ -28,15 +54,22 @@ from fs.errors import RemoteConnectionError
 from fs.errors import RemoveRootError
 from fs.errors import ResourceInvalidError
 from fs.errors import ResourceNotFoundError
+from fs.errors import UnsupportedError
+from fs.filelike import FileLikeBase
 from fs.filelike import SpooledTemporaryFile
 from fs.filelike import StringIO
 from fs.path import abspath
 from fs.path import basename
 from fs.path import dirname
+from fs.path import frombase
 from fs.path import normpath
+from fs.path import pathcombine
 from fs.path import pathjoin
 from fs.path import recursepath
-from fs.remote import RemoteFileBuffer
+from fs.path import relpath
+from fs.watch import CREATED
+from fs.watch import MODIFIED
+from fs.watch import REMOVED
 
 
 # Override the default message to display the operation and path together.
@@ -103,6 +136,10 @@ def _conv_smb_errors(outer):
                 elif msg_status == 0x103:
                     # Unknown error, but message says it is not found.
                     raise ResourceNotFoundError(path=path)
+                elif msg_status in (0xc0000002, 0xc0000003, 0xc000000d):
+                    # Not implemented, invalid information class or invalid
+                    # parameter: the server does not support the request.
+                    raise UnsupportedError('access', path=path, details=e)
                 elif msg_status == 0xc000000f:
                     raise ResourceNotFoundError(path=path)
                 elif msg_status == 0xc0000022:
@@ -123,6 +160,8 @@ def _conv_smb_errors(outer):
                     raise PasswordExpiredError(path=path)
                 elif msg_status == 0xc00000ba:
                     raise ResourceInvalidError(path=path)
+                elif msg_status == 0xc00000bb:
+                    raise UnsupportedError('access', path=path, details=e)
                 elif msg_status == 0xc00000cc:
                     # Share does not exist.
                     raise ResourceInvalidError(path=share)
@@ -182,6 +221,46 @@ def _determine_cause(outer):
     return inner
 
 
+def _wildcard_matcher(wildcard):
+    """ Callable matching names against a wildcard string or callable. """
+    if wildcard is None or callable(wildcard):
+        return wildcard
+    return re.compile(fnmatch.translate(wildcard)).match
+
+
+def _server_pattern(wildcard):
+    """ Wildcard to send along with a listing, if the server can apply it.
+
+        Only `*` and `?` globs are sent.  Servers may match them differently,
+        for instance without regard to case, so the names returned are still
+        matched on the client.
+    """
+    if (wildcard is None or callable(wildcard) or
+            any(c in wildcard for c in '[]<>"/\\')):
+        return None
+    return wildcard
+
+
+def _imap_unordered(func, items, max_workers):
+    """ Yield `func(item)` for each item as the calls complete.
+
+        Calls run on up to `max_workers` threads.  The first exception raised
+        by a call is raised here.
+    """
+    items = list(items)
+    if max_workers <= 1 or len(items) <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    pool = ThreadPool(min(max_workers, len(items)))
+    try:
+        for result in pool.imap_unordered(func, items):
+            yield result
+    finally:
+        pool.terminate()
+
+
 def _absnorm_path(num_paths):
     """ Convert path (first) argument to absolute and normalize it.
 
@@ -215,6 +294,1509 @@ class AbstractCacheBackend(object):
     def get_many(self, keys):
         pass
 
+    def delete(self, key):
+        pass
+
+    def delete_many(self, keys):
+        pass
+
+    def delete_prefix(self, prefix):
+        """ Delete every key starting with `prefix`, where supported. """
+        pass
+
+
+class LRUCacheBackend(AbstractCacheBackend):
+    """ Thread-safe in-process cache holding at most `max_entries` entries.
+
+        Entries expire `timeout` seconds after being set (never if None) and
+        the least recently used entry is evicted once the cache is full.  One
+        instance can be shared by several SMBFS instances.
+    """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __reduce__(self):
+        # Pickled copies start empty.
+        return (self.__class__, (self.max_entries, ))
+
+    def _set(self, key, value, expires):
+        self._entries.pop(key, None)
+        self._entries[key] = (value, expires)
+
+    def _get(self, key, now):
+        try:
+            value, expires = self._entries.pop(key)
+        except KeyError:
+            return None
+        if expires is not None and expires <= now:
+            return None
+        self._entries[key] = (value, expires)
+        return value
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def set(self, key, value, timeout):
+        expires = None if timeout is None else time.time() + timeout
+        with self._lock:
+            self._set(key, value, expires)
+            self._evict()
+
+    def get(self, key):
+        with self._lock:
+            return self._get(key, time.time())
+
+    def set_many(self, items, timeout):
+        expires = None if timeout is None else time.time() + timeout
+        with self._lock:
+            for key, value in items.items():
+                self._set(key, value, expires)
+            self._evict()
+
+    def get_many(self, keys):
+        now = time.time()
+        results = {}
+        with self._lock:
+            for key in keys:
+                value = self._get(key, now)
+                if value is not None:
+                    results[key] = value
+        return results
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def delete_prefix(self, prefix):
+        with self._lock:
+            for key in [k for k in self._entries if k.startswith(prefix)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def _remove_quietly(path):
+    """ Delete a local file, if it still exists. """
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class ContentCache(object):
+    """ Local copies of remote files kept in `directory`.
+
+        Each copy is recorded with the size and modification time of the
+        remote file and only served while they still match.  Files larger
+        than `max_file_size` are not kept, and the least recently used
+        copies are removed once together they take more than `max_bytes`.
+        Copies left in the directory by an earlier process are reused.  One
+        instance can be shared by several SMBFS instances.
+
+        Processes may share a directory, but each counts only the copies it
+        found at startup or made itself against `max_bytes`, so together
+        they can exceed it.  Copies found at startup are matched by
+        invalidate_prefix() once they have been looked up.
+    """
+    # Temporary files older than this many seconds are taken for downloads
+    # interrupted by an earlier process and deleted at startup.
+    stale_tmp_age = 24 * 60 * 60
+
+    def __init__(self, directory, max_bytes=1024 * 1024 * 1024,
+                 max_file_size=64 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_file_size = min(max_file_size, max_bytes)
+        # (size, mtime) of the copy of each key digest, least recent first.
+        self._entries = OrderedDict()
+        # Key of each digest looked up or stored by this process.
+        self._keys = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __reduce__(self):
+        return (self.__class__, (self.directory, self.max_bytes,
+                                 self.max_file_size))
+
+    def _load(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        found = []
+        stale = time.time() - self.stale_tmp_age
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                digest, size, mtime = name.split('_')
+                entry = (int(size), float(mtime))
+                found.append((os.path.getmtime(path), digest, entry))
+            except ValueError:
+                # Downloads still in progress in other processes are kept.
+                if name.startswith('.tmp') and os.path.getmtime(path) < stale:
+                    _remove_quietly(path)
+            except OSError:
+                # Removed by another process meanwhile.
+                pass
+        for _, digest, entry in sorted(found):
+            self._entries[digest] = entry
+            self._bytes += entry[0]
+        self._evict()
+
+    def _digest(self, key):
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        return hashlib.sha1(key).hexdigest()
+
+    def _path(self, digest, entry):
+        return os.path.join(self.directory,
+                            '{0}_{1}_{2!r}'.format(digest, *entry))
+
+    def _remove(self, digest):
+        """ Forget the copy of a digest and delete it.  Must hold the lock. """
+        entry = self._entries.pop(digest, None)
+        self._keys.pop(digest, None)
+        if entry is not None:
+            self._bytes -= entry[0]
+            _remove_quietly(self._path(digest, entry))
+
+    def _evict(self):
+        while self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    def get(self, key, size, mtime):
+        """ Path of the copy of `key` if it has this size and mtime. """
+        digest = self._digest(key)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                return None
+            if entry != (size, mtime):
+                self._remove(digest)
+                return None
+            self._entries[digest] = self._entries.pop(digest)
+            self._keys[digest] = key
+            return self._path(digest, entry)
+
+    def put(self, key, size, mtime, fill):
+        """ Store a copy of `key` written by `fill(file_obj)`.
+
+            Returns the path of the copy, or None if it is too large or
+            `fill` did not write `size` bytes.
+        """
+        if size > self.max_file_size:
+            return None
+        digest = self._digest(key)
+        entry = (size, mtime)
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                fill(f)
+                written = f.tell()
+            if written != size:
+                # The file changed while it was copied.
+                _remove_quietly(tmp_path)
+                return None
+            with self._lock:
+                self._remove(digest)
+                try:
+                    os.rename(tmp_path, self._path(digest, entry))
+                except OSError:
+                    # The directory was cleaned up by another process.
+                    _remove_quietly(tmp_path)
+                    return None
+                self._entries[digest] = entry
+                self._keys[digest] = key
+                self._bytes += size
+                self._evict()
+        except BaseException:
+            _remove_quietly(tmp_path)
+            raise
+        return self._path(digest, entry)
+
+    def invalidate(self, key):
+        """ Delete the copy of `key`, if any. """
+        digest = self._digest(key)
+        with self._lock:
+            self._remove(digest)
+
+    def invalidate_prefix(self, prefix):
+        """ Delete the copies of the keys starting with `prefix`. """
+        with self._lock:
+            for digest, key in list(self._keys.items()):
+                if key.startswith(prefix):
+                    self._remove(digest)
+
+    def clear(self):
+        with self._lock:
+            for digest in list(self._entries):
+                self._remove(digest)
+
+
+class AbstractMetricsBackend(object):
+    """ Receiver of the measurements taken by SMBFS, ignoring them. """
+
+    def request(self, name, seconds, size, failed):
+        """ A pysmb call `name` took `seconds` and moved `size` bytes. """
+        pass
+
+    def cache(self, name, hit):
+        """ A lookup in cache `name` was answered from it or not. """
+        pass
+
+    def wait(self, name, seconds):
+        """ A thread waited `seconds` for lock `name`. """
+        pass
+
+
+# Upper bounds in seconds of the buckets of latency histograms, doubling from
+# 100 microseconds.  Slower calls fall in one more, unbounded bucket.
+LATENCY_BUCKETS = tuple(0.0001 * 2 ** i for i in range(20))
+
+
+class MetricsCollector(AbstractMetricsBackend):
+    """ Thread-safe in-process totals of the measurements of SMBFS.
+
+        Each pysmb call is counted by name with its errors, total time, bytes
+        transferred and a histogram of its latency over LATENCY_BUCKETS.
+        Recording one takes a few additions under a lock, so a collector can
+        be left on in production.  One instance can be shared by several
+        SMBFS instances.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def __reduce__(self):
+        # Pickled copies start empty.
+        return (self.__class__, ())
+
+    def reset(self):
+        with self._lock:
+            self._requests = {}
+            self._caches = {}
+            self._waits = {}
+
+    def request(self, name, seconds, size, failed):
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        with self._lock:
+            stats = self._requests.get(name)
+            if stats is None:
+                stats = self._requests[name] = [
+                    0, 0, 0.0, 0, [0] * (len(LATENCY_BUCKETS) + 1)]
+            stats[0] += 1
+            if failed:
+                stats[1] += 1
+            stats[2] += seconds
+            stats[3] += size
+            stats[4][bucket] += 1
+
+    def cache(self, name, hit):
+        with self._lock:
+            stats = self._caches.get(name)
+            if stats is None:
+                stats = self._caches[name] = [0, 0]
+            stats[0 if hit else 1] += 1
+
+    def wait(self, name, seconds):
+        with self._lock:
+            stats = self._waits.get(name)
+            if stats is None:
+                stats = self._waits[name] = [0, 0.0, 0.0]
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+
+    def snapshot(self):
+        """ Totals so far as plain dicts, for instance to export as JSON. """
+        with self._lock:
+            return {
+                'requests': dict(
+                    (name, {'count': s[0], 'errors': s[1], 'seconds': s[2],
+                            'bytes': s[3], 'histogram': list(s[4])})
+                    for name, s in self._requests.items()),
+                'cache': dict((name, {'hits': s[0], 'misses': s[1]})
+                              for name, s in self._caches.items()),
+                'waits': dict(
+                    (name, {'count': s[0], 'seconds': s[1],
+                            'max_seconds': s[2]})
+                    for name, s in self._waits.items())}
+
+
+# Cached in place of the information of a path known not to exist.
+_CACHED_NOT_FOUND = False
+
+
+# Marks a key deleted from an SMBInfo.
+_DELETED = object()
+
+
+class SMBInfo(object):
+    """ Information on a path, as cached and returned by getinfo().
+
+        Only the name, size, type and raw timestamps are stored, so large
+        listings stay small.  It reads as the usual PyFilesystem info dict;
+        the `*_time` datetimes are built when accessed.  getinfo() and the
+        listings hand out a copy() sharing the stored values, and keys set
+        or deleted on it are kept apart, so callers may edit it like a dict
+        without touching the cache.
+    """
+    __slots__ = ('name', 'size', 'is_dir', 'ctime', 'atime', 'mtime',
+                 '_changes')
+
+    _keys = ('size', 'st_mode', 'created_time', 'st_ctime', 'accessed_time',
+             'st_atime', 'modified_time', 'st_mtime')
+
+    def __init__(self, name, size, is_dir, ctime, atime, mtime):
+        self.name = name
+        self.size = size
+        self.is_dir = is_dir
+        self.ctime = ctime
+        self.atime = atime
+        self.mtime = mtime
+        # Keys set or deleted, the latter mapped to _DELETED.
+        self._changes = None
+
+    @classmethod
+    def from_shared_file(cls, info, name=None):
+        """ Information held by a pysmb SharedFile, optionally renamed. """
+        return cls(info.filename if name is None else name, info.file_size,
+                   info.isDirectory,
+                   info.create_time, info.last_access_time,
+                   info.last_write_time)
+
+    @classmethod
+    def new(cls, name, is_dir, size, info=None):
+        """ Information on a path changed through the filesystem.
+
+            Times are taken from the local clock.  `info` is the previous
+            information on the path, if any, whose creation time is kept.
+        """
+        now = time.time()
+        return cls(name, size, is_dir, now if info is None else info.ctime,
+                   now, now)
+
+    def renamed(self, name):
+        """ The same information under another name. """
+        return SMBInfo(name, self.size, self.is_dir, self.ctime, self.atime,
+                       self.mtime)
+
+    def copy(self):
+        """ Copy whose keys can be changed apart from this one. """
+        info = self.renamed(self.name)
+        if self._changes:
+            info._changes = dict(self._changes)
+        return info
+
+    def __reduce__(self):
+        # Changes are pickled as the keys set and the keys deleted.
+        state = None
+        if self._changes:
+            state = (dict((key, value)
+                          for key, value in self._changes.items()
+                          if value is not _DELETED),
+                     [key for key, value in self._changes.items()
+                      if value is _DELETED])
+        return (SMBInfo, (self.name, self.size, self.is_dir, self.ctime,
+                          self.atime, self.mtime), state)
+
+    def __setstate__(self, state):
+        self._changes, deleted = state
+        self._changes.update((key, _DELETED) for key in deleted)
+
+    def _stored(self, key):
+        if key == 'size':
+            return self.size
+        elif key == 'st_mode':
+            return stat.S_IFDIR if self.is_dir else stat.S_IFREG
+        elif key == 'created_time':
+            return datetime.datetime.fromtimestamp(self.ctime)
+        elif key == 'st_ctime':
+            return self.ctime
+        elif key == 'accessed_time':
+            return datetime.datetime.fromtimestamp(self.atime)
+        elif key == 'st_atime':
+            return self.atime
+        elif key == 'modified_time':
+            return datetime.datetime.fromtimestamp(self.mtime)
+        elif key == 'st_mtime':
+            return self.mtime
+        raise KeyError(key)
+
+    def __getitem__(self, key):
+        if self._changes and key in self._changes:
+            value = self._changes[key]
+            if value is _DELETED:
+                raise KeyError(key)
+            return value
+        return self._stored(key)
+
+    def __setitem__(self, key, value):
+        if self._changes is None:
+            self._changes = {}
+        self._changes[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if key in self._keys:
+            self[key] = _DELETED
+        else:
+            del self._changes[key]
+
+    def __contains__(self, key):
+        if self._changes and key in self._changes:
+            return self._changes[key] is not _DELETED
+        return key in self._keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        if not isinstance(other, Mapping):
+            return NotImplemented
+        return dict(self.items()) == dict(other.items())
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '<SMBInfo {0!r} size={1} dir={2}>'.format(
+            self.name, self.size, self.is_dir)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def has_key(self, key):
+        return key in self
+
+    def keys(self):
+        if not self._changes:
+            return list(self._keys)
+        return ([key for key in self._keys
+                 if self._changes.get(key) is not _DELETED] +
+                [key for key, value in self._changes.items()
+                 if key not in self._keys and value is not _DELETED])
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def iterkeys(self):
+        return iter(self.keys())
+
+    def itervalues(self):
+        return (self[key] for key in self.keys())
+
+    def iteritems(self):
+        return ((key, self[key]) for key in self.keys())
+
+    def setdefault(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            self[key] = default
+            return default
+
+    def pop(self, key, *default):
+        try:
+            value = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[key]
+        return value
+
+    def popitem(self):
+        for key in self.keys():
+            return key, self.pop(key)
+        raise KeyError('popitem(): dictionary is empty')
+
+    def update(self, *args, **kwargs):
+        for other in args + (kwargs, ):
+            if hasattr(other, 'keys'):
+                for key in other.keys():
+                    self[key] = other[key]
+            else:
+                for key, value in other:
+                    self[key] = value
+
+    def clear(self):
+        for key in self.keys():
+            del self[key]
+
+
+# Registered rather than subclassed, as the Python 2 ABCs lack __slots__.
+MutableMapping.register(SMBInfo)
+
+
+# Errors after which a connection can no longer be trusted and must not be
+# returned to the pool.
+_CONNECTION_ERRORS = (socket.error, NotConnectedError, NotReadyError,
+                      SMBTimeout, RemoteConnectionError)
+
+
+class SMBConnectionPool(object):
+    """ Bounded, thread-safe pool of authenticated SMB connections.
+
+        Connections are created on demand by calling `factory` until
+        `max_size` are open, after which callers wait for one to be checked
+        back in.  Idle connections above `min_size` are closed once unused for
+        `idle_timeout` seconds.  A connection idle for longer than
+        `health_check_interval` seconds is probed with an echo before being
+        handed out, and a dead one is replaced transparently.
+    """
+
+    def __init__(self, factory, max_size=4, min_size=0, idle_timeout=300,
+                 health_check_interval=60):
+        if max_size < 1:
+            raise ValueError('max_size must be at least 1')
+        self.factory = factory
+        self.max_size = max_size
+        self.min_size = min(min_size, max_size)
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+
+        # Idle connections with the time they were checked in.  Used as a
+        # stack so the most recently used (and most likely alive) connection
+        # is handed out first.
+        self._idle = []
+        self._size = 0
+        # Connections checked out before the last clear() are closed rather
+        # than reused when they are checked in.
+        self._generation = 0
+        self._generations = {}
+        self._cond = threading.Condition(threading.Lock())
+
+    @property
+    def size(self):
+        """ Number of open connections, idle or checked out. """
+        return self._size
+
+    def checkout(self, timeout=None):
+        """ Take a connection from the pool, creating one if allowed.
+
+            Raises RemoteConnectionError if none becomes available within
+            `timeout` seconds.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            conn = None
+            with self._cond:
+                expired = self._reap()
+                while not self._idle and self._size >= self.max_size:
+                    if deadline is None:
+                        self._cond.wait()
+                    else:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            raise RemoteConnectionError(
+                                'Timed out waiting for an SMB connection')
+                        self._cond.wait(remaining)
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                else:
+                    self._size += 1
+            self._close_all(expired)
+
+            if conn is None:
+                try:
+                    conn = self.factory()
+                except BaseException:
+                    self._release_slot()
+                    raise
+                with self._cond:
+                    self._generations[id(conn)] = self._generation
+                return conn
+
+            if self._is_healthy(conn, last_used):
+                return conn
+            self.discard(conn)
+
+    def checkin(self, conn):
+        """ Return a healthy connection to the pool. """
+        with self._cond:
+            if self._generations.get(id(conn)) == self._generation:
+                self._idle.append((conn, time.time()))
+                self._cond.notify()
+                return
+        self.discard(conn)
+
+    def discard(self, conn):
+        """ Close a checked out connection and free its slot. """
+        self._close_all([conn])
+        self._release_slot()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """ Context manager checking a connection out and back in.
+
+            The connection is discarded instead if the block raises an error
+            indicating the connection is broken.
+        """
+        conn = self.checkout(timeout)
+        broken = False
+        try:
+            yield conn
+        except _CONNECTION_ERRORS:
+            broken = True
+            raise
+        finally:
+            if broken:
+                self.discard(conn)
+            else:
+                self.checkin(conn)
+
+    def clear(self):
+        """ Close all idle connections.
+
+            Connections currently checked out are closed when checked in.  The
+            pool remains usable and opens new connections on demand.
+        """
+        with self._cond:
+            idle = [conn for conn, _ in self._idle]
+            self._idle = []
+            self._size -= len(idle)
+            self._generation += 1
+            for conn in idle:
+                self._generations.pop(id(conn), None)
+            self._cond.notify_all()
+        self._close_all(idle)
+
+    def _release_slot(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def _reap(self):
+        """ Remove expired idle connections.  Must hold the lock. """
+        if self.idle_timeout is None:
+            return []
+        cutoff = time.time() - self.idle_timeout
+        expired = []
+        # The stack is ordered by last use, so the oldest are at the bottom.
+        while (self._idle and self._idle[0][1] < cutoff and
+               self._size > self.min_size):
+            conn, _ = self._idle.pop(0)
+            self._generations.pop(id(conn), None)
+            self._size -= 1
+            expired.append(conn)
+        return expired
+
+    def _is_healthy(self, conn, last_used):
+        if getattr(conn, 'sock', True) is None:
+            return False
+        if (self.health_check_interval is not None and
+                time.time() - last_used > self.health_check_interval):
+            try:
+                conn.echo(b'smbfs')
+            except Exception:
+                return False
+        return True
+
+    def _close_all(self, conns):
+        for conn in conns:
+            with self._cond:
+                self._generations.pop(id(conn), None)
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+
+class SMBSessionRegistry(object):
+    """ Connection pools shared by the SMBFS instances of a process.
+
+        Instances created with `shared_sessions=True` lease the pool kept
+        here for their server, port, NetBIOS name and credentials instead of
+        opening their own, so short-lived instances reuse sessions that are
+        already authenticated.  The first instance to lease a pool sets its
+        size.  A pool no instance leases any more is closed once unused for
+        `idle_timeout` seconds, by a timer running while there are such
+        pools.
+    """
+
+    def __init__(self, idle_timeout=300):
+        self.idle_timeout = idle_timeout
+        # Pool, number of leases and time of the last release by key.
+        self._pools = {}
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def __len__(self):
+        return len(self._pools)
+
+    def acquire(self, key, factory):
+        """ Lease the pool for `key`, creating it by calling `factory`. """
+        with self._lock:
+            expired = self._expire()
+            entry = self._pools.get(key)
+            if entry is None:
+                entry = self._pools[key] = [factory(), 0, None]
+            entry[1] += 1
+        self._close_all(expired)
+        return entry[0]
+
+    def release(self, key):
+        """ End a lease taken with acquire(). """
+        with self._lock:
+            entry = self._pools.get(key)
+            if entry is not None:
+                entry[1] -= 1
+                if not entry[1]:
+                    entry[2] = time.time()
+            expired = self._expire()
+            self._schedule()
+        self._close_all(expired)
+
+    def clear(self):
+        """ Close and forget every pool no instance is leasing. """
+        with self._lock:
+            expired = [self._pools.pop(key)[0]
+                       for key, entry in list(self._pools.items())
+                       if not entry[1]]
+        self._close_all(expired)
+
+    def _expire(self):
+        """ Remove pools unleased for too long.  Must hold the lock. """
+        if self.idle_timeout is None:
+            return []
+        cutoff = time.time() - self.idle_timeout
+        return [self._pools.pop(key)[0]
+                for key, entry in list(self._pools.items())
+                if not entry[1] and entry[2] <= cutoff]
+
+    def _schedule(self):
+        """ Start the timer for the first unleased pool to expire, unless
+            it is running.  Must hold the lock.
+        """
+        if self.idle_timeout is None or self._timer is not None:
+            return
+        released = [entry[2] for entry in self._pools.values()
+                    if not entry[1]]
+        if not released:
+            return
+        delay = max(0, min(released) + self.idle_timeout - time.time())
+        self._timer = threading.Timer(delay, self._expire_idle)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _expire_idle(self):
+        """ Close the pools unleased for too long, from the timer. """
+        with self._lock:
+            self._timer = None
+            expired = self._expire()
+            self._schedule()
+        self._close_all(expired)
+
+    def _close_all(self, pools):
+        for pool in pools:
+            pool.clear()
+
+
+# Registry used by SMBFS instances created with `shared_sessions=True`.
+session_registry = SMBSessionRegistry()
+
+
+def _connection_factory(username, password, client_name, server_name,
+                        server_IP, port, metrics):
+    """ Function opening and authenticating a new connection to a server.
+
+        It holds the connection parameters rather than an SMBFS, so a pool
+        shared by several instances keeps none of them alive.
+    """
+    @_conv_smb_errors
+    def connect():
+        conn = SMBConnection(username, password, client_name, server_name,
+                             use_ntlm_v2=True)
+        if metrics is not None:
+            conn = _MeteredConnection(conn, metrics)
+        conn.connect(server_IP, port)
+        return conn
+    return connect
+
+
+def _transferred(name, args, kwargs, result):
+    """ Number of bytes moved by a pysmb call, from its result. """
+    if name in ('retrieveFile', 'retrieveFileFromOffset'):
+        return result[1]
+    elif name == 'storeFile':
+        return result
+    elif name == 'storeFileFromOffset':
+        return result - kwargs.get('offset', args[3] if len(args) > 3 else 0)
+    return 0
+
+
+class _MeteredConnection(object):
+    """ pysmb connection reporting each of its calls to a metrics backend. """
+
+    def __init__(self, conn, metrics):
+        self._conn = conn
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        attr = getattr(self._conn, name)
+        if not callable(attr):
+            return attr
+
+        def request(*args, **kwargs):
+            start = time.time()
+            try:
+                result = attr(*args, **kwargs)
+            except BaseException:
+                self._metrics.request(name, time.time() - start, 0, True)
+                raise
+            self._metrics.request(name, time.time() - start,
+                                  _transferred(name, args, kwargs, result),
+                                  False)
+            return result
+        # Later calls find the wrapper without going through __getattr__.
+        setattr(self, name, request)
+        return request
+
+
+class _TimedLock(object):
+    """ Lock reporting the time spent acquiring it to a metrics backend. """
+
+    def __init__(self, lock, metrics, name):
+        self.lock = lock
+        self.metrics = metrics
+        self.name = name
+
+    def acquire(self, *args):
+        start = time.time()
+        acquired = self.lock.acquire(*args)
+        self.metrics.wait(self.name, time.time() - start)
+        return acquired
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class _RateLimiter(object):
+    """ Paces transfers sharing it to `rate` bytes per second overall. """
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self._lock = threading.Lock()
+        self._next = time.time()
+
+    def consume(self, size):
+        """ Wait for the turn of `size` bytes to be transferred. """
+        with self._lock:
+            now = time.time()
+            start = max(self._next, now)
+            self._next = start + size / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+
+class _ThrottledFile(object):
+    """ File whose reads and writes are paced by a _RateLimiter. """
+
+    def __init__(self, file_obj, limiter):
+        self.file_obj = file_obj
+        self.limiter = limiter
+
+    def read(self, size=-1):
+        data = self.file_obj.read(size)
+        self.limiter.consume(len(data))
+        return data
+
+    def write(self, data):
+        self.limiter.consume(len(data))
+        return self.file_obj.write(data)
+
+
+# Files up to this size are transferred in batches of up to this many files,
+# each batch on one connection.
+_SMALL_FILE_SIZE = 1024 * 1024
+_SMALL_FILE_BATCH = 32
+
+
+class _OffsetWriter(object):
+    """ Writes into a file shared between threads from a given offset. """
+
+    def __init__(self, file_obj, lock, offset):
+        self.file_obj = file_obj
+        self.lock = lock
+        self.offset = offset
+
+    def write(self, data):
+        with self.lock:
+            self.file_obj.seek(self.offset)
+            self.file_obj.write(data)
+        self.offset += len(data)
+
+
+def _batch_transfers(transfers):
+    """ Group small transfers together, leaving large ones alone.
+
+        `transfers` are tuples of a local path, a remote path and the size
+        of the file, possibly followed by more fields.
+    """
+    batch = []
+    for transfer in transfers:
+        if transfer[2] > _SMALL_FILE_SIZE:
+            yield [transfer]
+            continue
+        batch.append(transfer)
+        if len(batch) == _SMALL_FILE_BATCH:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+_MANIFEST_HEADER = b'smbfs-manifest 1\n'
+
+
+def _load_manifest(path):
+    """ (size, mtime) of each file of a sync manifest by relative path.
+
+        A missing manifest, or one in an unknown format, is empty.
+    """
+    entries = {}
+    if not os.path.exists(path):
+        return entries
+    with gzip.open(path, 'rb') as f:
+        if f.readline() != _MANIFEST_HEADER:
+            return entries
+        for line in f:
+            size, mtime, name = line.rstrip(b'\n').split(b'\t', 2)
+            # Names cannot contain backslashes, so only newlines are escaped.
+            name = name.decode('utf-8').replace(u'\\n', u'\n')
+            entries[name] = (int(size), float(mtime))
+    return entries
+
+
+def _save_manifest(path, entries):
+    """ Replace the sync manifest at `path` with `entries`. """
+    tmp_path = path + '.tmp'
+    with gzip.open(tmp_path, 'wb') as f:
+        f.write(_MANIFEST_HEADER)
+        for name, (size, mtime) in entries.items():
+            f.write(u'{0}\t{1!r}\t{2}\n'.format(
+                size, mtime, name.replace(u'\n', u'\\n')).encode('utf-8'))
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # Windows does not rename over an existing file.
+        os.remove(path)
+        os.rename(tmp_path, path)
+
+
+def _same_local_file(local_path, size, mtime):
+    """ Whether a local file has the given size and modification time. """
+    try:
+        st = os.stat(local_path)
+    except OSError:
+        return False
+    # Local filesystems may keep modification times to the second only.
+    return st.st_size == size and abs(st.st_mtime - mtime) < 1
+
+
+class SMBReadFile(FileLikeBase):
+    """ Read-only file fetching blocks of a remote file as they are read.
+
+        Nothing is transferred until the first read.  A miss fetches the block
+        holding the current position with one ranged request; while reading
+        sequentially the following `read_ahead` blocks are fetched along with
+        it.  Only the most recent blocks are kept, so memory use does not
+        depend on the size of the file.
+    """
+
+    def __init__(self, fs, path, size, block_size, read_ahead):
+        super(SMBReadFile, self).__init__()
+        self.fs = fs
+        self.path = path
+        self.name = path
+        self.mode = 'rb'
+        self.size = size
+        self.block_size = block_size
+        self.read_ahead = read_ahead
+        self._pos = 0
+        self._blocks = OrderedDict()
+        self._last_block = None
+
+    def _block(self, index):
+        """ Return the data of block `index`, fetching it if needed. """
+        try:
+            data = self._blocks.pop(index)
+        except KeyError:
+            pass
+        else:
+            self._blocks[index] = data
+            return data
+
+        # Read ahead only when the blocks are being consumed in order.
+        count = 1
+        if self._last_block is not None and index == self._last_block + 1:
+            count += self.read_ahead
+        offset = index * self.block_size
+        buf = io.BytesIO()
+        self.fs._retrieveFileFromOffset(self.path, buf, offset,
+                                        count * self.block_size)
+        fetched = buf.getvalue()
+
+        for n in range(count):
+            start = n * self.block_size
+            if start >= len(fetched) and n:
+                break
+            self._blocks[index + n] = fetched[start:start + self.block_size]
+        while len(self._blocks) > self.read_ahead + 2:
+            self._blocks.popitem(last=False)
+        self._last_block = index + count - 1
+        return self._blocks[index]
+
+    def _read(self, sizehint=-1):
+        if self._pos >= self.size:
+            return None
+        index, start = divmod(self._pos, self.block_size)
+        end = self.block_size
+        if sizehint > 0:
+            end = min(end, start + max(sizehint, self._bufsize))
+        data = self._block(index)[start:end]
+        if not data:
+            # The file was truncated after it was opened.
+            return None
+        self._pos += len(data)
+        return data
+
+    def _seek(self, offset, whence):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += self.size
+        if offset < 0:
+            raise IOError(errno.EINVAL, 'Invalid seek position')
+        self._pos = offset
+
+    def _tell(self):
+        return self._pos
+
+    def close(self):
+        super(SMBReadFile, self).close()
+        self._blocks.clear()
+
+
+def _resize(fs, path, old_size, size, chunk_size):
+    """ Grow or shrink a remote file of `old_size` bytes to `size`. """
+    if size > old_size:
+        # Writing the last byte makes the server fill the gap with zeros.
+        fs._storeFileFromOffset(path, io.BytesIO(b'\0'), size - 1, False)
+    elif size < old_size:
+        # pysmb cannot set the end of file, so rewrite what is kept.
+        kept = SpooledTemporaryFile(max_size=chunk_size)
+        fs._retrieveFileFromOffset(path, kept, 0, size)
+        kept.seek(0)
+        fs._storeFileFromOffset(path, kept, 0, True)
+
+
+class SMBWriteFile(FileLikeBase):
+    """ Write-only file uploading data to the server as it is written.
+
+        Writes are gathered into chunks of `chunk_size` bytes and queued for
+        a background thread, so the upload overlaps with the producer.  Up to
+        `queue_size` chunks wait in the queue and as many are uploaded at
+        once.  The thread checks a
+        connection out for each upload of the queued chunks and returns it
+        right after, so an open file holds no connection while idle.
+        flush() waits for the data written so far to reach the server.
+        Upload errors are raised by every later write, flush or close, and
+        nothing more is uploaded after one.
+    """
+
+    def __init__(self, fs, path, chunk_size, queue_size, truncate=True):
+        super(SMBWriteFile, self).__init__(bufsize=chunk_size)
+        self.fs = fs
+        self.path = path
+        self.name = path
+        self.mode = 'wb'
+        self.chunk_size = chunk_size
+        self.queue_size = queue_size
+        self._pos = 0
+        self._size = 0
+        self._buffer = []
+        self._buffered = 0
+        self._queue = queue.Queue(queue_size)
+        self._thread = None
+        self._error = None
+
+        # Create or empty the file right away so open() reports errors and
+        # the file exists even if nothing is written.
+        if truncate:
+            self.fs._overwrite(path, io.BytesIO())
+
+    def _upload(self):
+        """ Upload queued chunks until told to stop by None. """
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                return
+            # Chunks queued meanwhile and following on go up together.
+            offset, parts = chunk[0], [chunk[1]]
+            end = offset + len(chunk[1])
+            stop = False
+            while len(parts) < self.queue_size:
+                try:
+                    chunk = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if chunk is None:
+                    stop = True
+                    break
+                if chunk[0] != end:
+                    self._store(offset, parts)
+                    offset, parts = chunk[0], []
+                parts.append(chunk[1])
+                end = chunk[0] + len(chunk[1])
+            self._store(offset, parts)
+            if stop:
+                return
+
+    def _store(self, offset, parts):
+        # After a failure the rest is dropped until the error is raised.
+        if self._error is None:
+            try:
+                self.fs._storeFileFromOffset(
+                    self.path, io.BytesIO(b''.join(parts)), offset, False)
+            except Exception as e:
+                self._error = e
+
+    def _finish(self):
+        """ Wait for the queued chunks to be uploaded. """
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def _push(self):
+        """ Queue the buffered data for upload. """
+        if not self._buffered:
+            return
+        if self._error is not None:
+            # The file has a hole already, so the rest is dropped.
+            self._buffer = []
+            self._buffered = 0
+            self._raise_error()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._upload)
+            self._thread.daemon = True
+            self._thread.start()
+        data = b''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        self._queue.put((self._pos - len(data), data))
+        self._raise_error()
+
+    def write(self, data):
+        self._raise_error()
+        super(SMBWriteFile, self).write(data)
+
+    def _write(self, data, flushing=False):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        self._pos += len(data)
+        self._size = max(self._size, self._pos)
+        if self._buffered >= self.chunk_size:
+            self._push()
+
+    def _seek(self, offset, whence):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += self._size
+        if offset < 0:
+            raise IOError(errno.EINVAL, 'Invalid seek position')
+        if offset != self._pos:
+            self._push()
+            self._pos = offset
+
+    def _tell(self):
+        return self._pos
+
+    def _truncate(self, size):
+        self._push()
+        self._finish()
+        _resize(self.fs, self.path, self._size, size, self.chunk_size)
+        self._size = size
+
+    def flush(self):
+        super(SMBWriteFile, self).flush()
+        self._push()
+        self._finish()
+
+    def close(self):
+        if not self.closed:
+            try:
+                self.flush()
+            finally:
+                self.closed = True
+        else:
+            self._raise_error()
+
+
+def _spool(data, encoding, errors, chunk_size):
+    """ Copy a string or file into a local spool.
+
+        Returns the spool and the number of bytes in it.
+    """
+    # Small files stay in memory.
+    spool = SpooledTemporaryFile(max_size=_SMALL_FILE_SIZE)
+    if isinstance(data, type(u'')):
+        data = data.encode(encoding or 'utf-8', errors or 'strict')
+    if not hasattr(data, 'read'):
+        data = StringIO(data)
+    chunk = data.read(chunk_size)
+    while chunk:
+        if isinstance(chunk, type(u'')):
+            chunk = chunk.encode(encoding or 'utf-8', errors or 'strict')
+        spool.write(chunk)
+        chunk = data.read(chunk_size)
+    return spool, spool.tell()
+
+
+class _WriteBehind(object):
+    """ Uploads of the files written by an SMBFS in write-behind mode.
+
+        Files are spooled locally and uploaded by up to `max_workers`
+        background threads.  The uploads of a path run one at a time in the
+        order they were queued, and a queued upload not started yet is
+        replaced by a newer one of the same path.  Writers wait while more
+        than `max_bytes` are queued.  Errors are kept until the next
+        barrier() raises them.
+    """
+
+    def __init__(self, fs, max_bytes, max_workers):
+        self.fs = fs
+        self.max_bytes = max_bytes
+        self.max_workers = max_workers
+        # Spool and size of the next upload of each path, the paths being
+        # uploaded and the paths ready to be.
+        self._waiting = {}
+        self._running = set()
+        self._ready = deque()
+        self._bytes = 0
+        self._errors = []
+        self._workers = 0
+        self._cond = threading.Condition(threading.Lock())
+        self._local = threading.local()
+
+    def put(self, path, spool, size):
+        """ Queue the upload of `spool`, holding `size` bytes, to `path`. """
+        with self._cond:
+            while self._bytes and self._bytes + size > self.max_bytes:
+                self._cond.wait()
+            old = self._waiting.pop(path, None)
+            if old is not None:
+                old[0].close()
+                self._bytes -= old[1]
+            elif path not in self._running:
+                self._ready.append(path)
+            self._waiting[path] = (spool, size)
+            self._bytes += size
+            if self._workers < self.max_workers:
+                self._workers += 1
+                worker = threading.Thread(target=self._work)
+                worker.daemon = True
+                worker.start()
+
+    def wait(self, match):
+        """ Wait until no path for which `match(path)` is true is pending.
+
+            Returns at once in the upload threads, so an upload never waits
+            for itself.
+        """
+        if getattr(self._local, 'worker', False):
+            return
+        with self._cond:
+            while (any(match(path) for path in self._waiting) or
+                   any(match(path) for path in self._running)):
+                self._cond.wait()
+
+    def barrier(self):
+        """ Wait for every upload and raise the first error since the last
+            barrier, if any.
+        """
+        self.wait(lambda path: True)
+        with self._cond:
+            errors, self._errors = self._errors, []
+        if errors:
+            raise errors[0]
+
+    def _work(self):
+        self._local.worker = True
+        while True:
+            with self._cond:
+                if not self._ready:
+                    # Threads are started again when more uploads come.
+                    self._workers -= 1
+                    return
+                path = self._ready.popleft()
+                spool, size = self._waiting.pop(path)
+                self._running.add(path)
+            try:
+                self._upload(path, spool)
+            except Exception as e:
+                with self._cond:
+                    self._errors.append(e)
+            finally:
+                spool.close()
+                with self._cond:
+                    self._running.discard(path)
+                    self._bytes -= size
+                    if path in self._waiting:
+                        self._ready.append(path)
+                    self._cond.notify_all()
+
+    def _upload(self, path, spool):
+        fs = self.fs
+
+        def store(path):
+            spool.seek(0)
+            fs._overwrite(path, spool)
+
+        with fs._connection():
+            fs._replace(path, store)
+
+
+class _WriteBehindFile(FileLikeBase):
+    """ File opened for writing in write-behind mode.
+
+        Data is written to a local spool, queued for upload on close.
+    """
+
+    def __init__(self, fs, path, chunk_size):
+        super(_WriteBehindFile, self).__init__(bufsize=chunk_size)
+        self.fs = fs
+        self.path = path
+        self.name = path
+        self.mode = 'wb'
+        self._spool = SpooledTemporaryFile(max_size=_SMALL_FILE_SIZE)
+
+    def _write(self, data, flushing=False):
+        self._spool.write(data)
+
+    def _seek(self, offset, whence):
+        self._spool.seek(offset, whence)
+
+    def _tell(self):
+        return self._spool.tell()
+
+    def _truncate(self, size):
+        self._spool.truncate(size)
+
+    def close(self):
+        if not self.closed:
+            super(_WriteBehindFile, self).close()
+            self._spool.seek(0, 2)
+            self.fs._write_behind.put(self.path, self._spool,
+                                      self._spool.tell())
+
+
+class SMBRandomAccessFile(FileLikeBase):
+    """ File open for reading and writing ranges in place.
+
+        Reads fetch the range asked for, up to `block_size` bytes at a time,
+        and writes are gathered into chunks of `chunk_size` bytes sent at
+        their offset, so only the bytes read or changed cross the network.
+        In append modes every write goes to the end of the file.
+    """
+
+    def __init__(self, fs, path, mode, size, chunk_size, block_size):
+        super(SMBRandomAccessFile, self).__init__(bufsize=chunk_size)
+        self.fs = fs
+        self.path = path
+        self.name = path
+        self.mode = mode
+        self.size = size
+        self.chunk_size = chunk_size
+        self.block_size = block_size
+        self._append = 'a' in mode
+        self._pos = size if self._append else 0
+
+    def _read(self, sizehint=-1):
+        if self._pos >= self.size:
+            return None
+        length = self.block_size
+        if sizehint > 0:
+            length = min(length, max(sizehint, self._bufsize))
+        buf = io.BytesIO()
+        self.fs._retrieveFileFromOffset(self.path, buf, self._pos, length)
+        data = buf.getvalue()
+        if not data:
+            # The file was truncated by someone else.
+            return None
+        self._pos += len(data)
+        return data
+
+    def _write(self, data, flushing=False):
+        if not flushing and len(data) < self.chunk_size:
+            return data
+        if self._append:
+            self._pos = self.size
+        self._pos = self.fs._storeFileFromOffset(
+            self.path, io.BytesIO(data), self._pos, False)
+        self.size = max(self.size, self._pos)
+
+    def _seek(self, offset, whence):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += self.size
+        if offset < 0:
+            raise IOError(errno.EINVAL, 'Invalid seek position')
+        self._pos = offset
+
+    def _tell(self):
+        return self._pos
+
+    def _truncate(self, size):
+        _resize(self.fs, self.path, self.size, size, self.chunk_size)
+        self.size = size
+
 
 class SMBFS(FS):
     """ Filesystem stored on a SMB share.
@@ -222,6 +1804,19 @@ class SMBFS(FS):
         This wraps pysmb (https://pypi.python.org/pypi/pysmb) to access SMB
         shares.
     """
+    # Size of the blocks fetched by files opened for reading and the number
+    # of blocks read ahead while reading sequentially.  Both can also be
+    # passed to open() as `block_size` and `read_ahead`.
+    read_block_size = 1024 * 1024
+    read_ahead = 2
+
+    # Size of the ranges download() fetches in parallel.
+    download_part_size = 8 * 1024 * 1024
+
+    # Number of chunks of `chunk_size` bytes a file opened for writing may
+    # queue while its upload catches up.
+    write_queue_size = 4
+
     _meta = {'thread_safe': True,
              'virtual': False,
              'read_only': False,
@@ -236,244 +1831,831 @@ class SMBFS(FS):
 
     def __init__(self, username, password, server_name, server_IP, share,
                  port=139, client_name=None, cache=AbstractCacheBackend(),
-                 thread_synchronize=_thread_synchronize_default):
+                 thread_synchronize=_thread_synchronize_default,
+                 max_connections=4, min_connections=0, idle_timeout=300,
+                 atomic_setcontents=False, cache_timeout=60,
+                 negative_cache_timeout=10, shared_sessions=False,
+                 content_cache=None, write_behind=False,
+                 write_behind_max_bytes=64 * 1024 * 1024, metrics=None):
         self.username = username
         self.password = password
         self.server_name = server_name
         self.share = share
         self.server_IP = server_IP
         self.port = port
+        self.max_connections = max_connections
+        self.min_connections = min_connections
+        self.idle_timeout = idle_timeout
+        # AbstractMetricsBackend told of every pysmb call and cache lookup.
+        # The connections of a shared pool report to the instance opening
+        # them.
+        self.metrics = metrics
+        # Lease the pool of `session_registry` instead of opening our own.
+        self.shared_sessions = shared_sessions
+        self._leased = False
         self._conn = None
 
-        self._cache = cache
-
         # Automatically generate a client name if not provided.
         if client_name is None:
             self.client_name = 'fs{0}'.format(''.join(random.choice(
-                string.uppercase + string.digits) for i in xrange(12)))
+                string.ascii_uppercase + string.digits) for i in range(12)))
         else:
             self.client_name = client_name
+        self._init_pool()
+
+        self._cache = cache
+        self._cache_lock = threading.Lock()
+        # Lookups running on the server for each path, as the number of them
+        # and a generation bumped when the path changes meanwhile.
+        self._fetches = {}
+        self._cache_prefix = "smbcache%s%s%s%s%s" % (
+            username, server_name, share, server_IP, share)
+        self.cache_timeout = cache_timeout
+        self.negative_cache_timeout = negative_cache_timeout
+        # ContentCache serving files opened for reading from local copies.
+        self.content_cache = content_cache
+
+        # Queue uploads of setcontents() and files opened for writing in the
+        # background, with at most `write_behind_max_bytes` spooled.
+        self.write_behind = write_behind
+        self.write_behind_max_bytes = write_behind_max_bytes
+        self._init_write_behind()
+
+        # Upload to a temporary file and rename it over the target.  This is
+        # not advertised as atomic: an existing target is moved aside first,
+        # so the path is missing between the two renames.
+        self.atomic_setcontents = atomic_setcontents
 
         super(SMBFS, self).__init__(thread_synchronize=thread_synchronize)
+        self._init_lock()
 
     def __getstate__(self):
-        # Close the connection to allow pickling.
-        self.close()
-        return super(SMBFS, self).__getstate__()
-
-    def _listPath(self, path, list_contents=False):
-        """ Path listing with SMB errors converted. """
-
-        # Explicitly convert the SMB errors to be able to catch the
-        # PyFilesystem error while listing the path.
-        if list_contents:
-
+        # Close the connection to allow pickling.  Shared sessions stay open
+        # for other instances, including copies unpickled in this process.
+        if self.shared_sessions:
+            self.flush()
+            state = super(SMBFS, self).__getstate__()
+            state['_conn'] = None
+            state['_leased'] = False
+        else:
+            self.close()
+            state = super(SMBFS, self).__getstate__()
+        del state['_pool']
+        del state['_local']
+        del state['_cache_lock']
+        del state['_fetches']
+        del state['_write_behind']
+        if self.metrics is not None:
+            # Pickle the kind of the lock rather than its wrapper.
+            state['_lock'] = bool(self.thread_synchronize)
+        return state
+
+    def __setstate__(self, state):
+        super(SMBFS, self).__setstate__(state)
+        self._init_lock()
+        self._init_pool()
+        self._cache_lock = threading.Lock()
+        self._fetches = {}
+        self._init_write_behind()
+
+    def _init_lock(self):
+        """ Report the waits for the lock of synchronized methods. """
+        if self.metrics is not None:
+            self._lock = _TimedLock(self._lock, self.metrics, 'synchronize')
+
+    def _init_write_behind(self):
+        self._write_behind = None
+        if self.write_behind:
+            self._write_behind = _WriteBehind(
+                self, self.write_behind_max_bytes, self.max_connections)
+
+    def _settle(self, path, tree=False):
+        """ Wait for write-behind uploads of a path, or below it with `tree`.
+        """
+        if self._write_behind is not None:
+            path = abspath(normpath(path))
+            prefix = path.rstrip('/') + '/'
+            self._write_behind.wait(lambda p: p == path or (
+                tree and p.startswith(prefix)))
+
+    def _settle_dir(self, path):
+        """ Wait for write-behind uploads of the files of a directory. """
+        if self._write_behind is not None:
+            self._write_behind.wait(lambda p: dirname(p) == path)
+
+    def _init_pool(self):
+        """ Create the connection pool and the per-thread checkout slot. """
+        if self.shared_sessions:
+            self._pool = session_registry.acquire(self._session_key(),
+                                                  self._new_pool)
+            self._leased = True
+        else:
+            self._pool = self._new_pool()
+        self._local = threading.local()
+
+    def _new_pool(self):
+        return SMBConnectionPool(
+            self._connection_factory(), max_size=self.max_connections,
+            min_size=self.min_connections, idle_timeout=self.idle_timeout)
+
+    def _session_key(self):
+        """ Key of the shared pool, holding a digest of the password. """
+        password = self.password
+        if not isinstance(password, bytes):
+            password = password.encode('utf-8')
+        return (self.server_IP, self.port, self.server_name, self.username,
+                hashlib.sha256(password).hexdigest())
+
+    def _connection_factory(self):
+        """ Function opening connections with the parameters of this
+            instance.
+        """
+        return _connection_factory(self.username, self.password,
+                                   self.client_name, self.server_name,
+                                   self.server_IP, self.port, self.metrics)
+
+    def _connect(self):
+        """ Open and authenticate a new connection to the server. """
+        return self._connection_factory()()
+
+    @contextmanager
+    def _connection(self):
+        """ Check out a pooled connection for the current thread.
+
+            Nested uses within one thread share the same connection, so a
+            method calling another never waits on the pool for a second one.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            yield conn
+            return
+
+        start = time.time()
+        with self._pool.connection() as conn:
+            if self.metrics is not None:
+                self.metrics.wait('checkout', time.time() - start)
+            self._local.conn = conn
             try:
-                # List all contents of a directory.
-
-                results = _conv_smb_errors(self.conn.listPath)(
-                    self.share, normpath(path))
-
-                bulk_cache_items = {}
-
-                for result in results:
-                    if result.filename == '..':
-                        continue
-                    if result.filename == '.':
-                        continue
-
-                    folder = path
-                    if path == '':
-                        folder = "/"
+                yield conn
+            finally:
+                self._local.conn = None
+
+    def _cache_key(self, path):
+        """ Key of the cached information of an absolute path. """
+        key = self._cache_prefix + path
+        if not isinstance(key, str):
+            key = key.encode('utf-8')
+        return key
+
+    def _listing_key(self, path):
+        """ Key of the cached listing of an absolute directory path. """
+        return self._cache_key(path.rstrip('/') + '/*')
+
+    @contextmanager
+    def _lookup(self, path):
+        """ Track a lookup of an absolute path on the server while it runs.
+
+            Yields a function that caches a value, unless the path or its
+            directory changed through this filesystem since the lookup
+            started: the value may predate the change.
+        """
+        with self._cache_lock:
+            fetch = self._fetches.setdefault(path, [0, 0])
+            fetch[0] += 1
+            generation = fetch[1]
+
+        def store(key, value, timeout):
+            with self._cache_lock:
+                if fetch[1] == generation:
+                    self._cache.set(key, value, timeout)
+        try:
+            yield store
+        finally:
+            with self._cache_lock:
+                fetch[0] -= 1
+                if not fetch[0]:
+                    del self._fetches[path]
+
+    def _changed(self, path, tree=False):
+        """ Stop running lookups of a path and of its directory, or of
+            anything below the path with `tree`, from caching their results.
+
+            This is called before the cached entries are dropped or patched.
+        """
+        parent = dirname(path)
+        prefix = path.rstrip('/') + '/'
+        with self._cache_lock:
+            for p, fetch in self._fetches.items():
+                if p == path or p == parent or (tree and p.startswith(prefix)):
+                    fetch[1] += 1
+
+    def _invalidate(self, path, tree=False):
+        """ Drop cached information of a path and of its parent directory.
+
+            This is used when it is unknown how a path changed.  With `tree`,
+            everything cached below the path is dropped as well, for a
+            directory that was removed or renamed.
+        """
+        path = abspath(normpath(path))
+        self._changed(path, tree)
+        self._cache.delete_many([self._cache_key(path),
+                                 self._cache_key(dirname(path)),
+                                 self._listing_key(dirname(path))])
+        if self.content_cache is not None:
+            self.content_cache.invalidate(self._cache_key(path))
+        if tree:
+            self._invalidate_below(path)
+
+    def _invalidate_below(self, path):
+        """ Drop everything cached below a directory path. """
+        prefix = self._cache_key(path.rstrip('/') + '/')
+        self._cache.delete_prefix(prefix)
+        if self.content_cache is not None:
+            self.content_cache.invalidate_prefix(prefix)
+
+    def _update_listing(self, path, update, tree=False):
+        """ Patch the entry of a path in its parent's cached listing.
+
+            `update` is called with the cached entry, or None if the listing
+            has none, and returns the new entry or None to remove it.  The
+            listing keeps its timestamp, so patching never extends its life.
+            Nothing is fetched if the listing is not cached.
+        """
+        path = abspath(normpath(path))
+        self._changed(path, tree)
+        self._cache.delete_many([self._cache_key(path),
+                                 self._cache_key(dirname(path))])
+        if self.content_cache is not None:
+            self.content_cache.invalidate(self._cache_key(path))
+        if tree:
+            self._invalidate_below(path)
+
+        key = self._listing_key(dirname(path))
+        with self._cache_lock:
+            listing = self._cache.get(key)
+            if not listing:
+                return
+            timestamp, entries = listing
+            remaining = self.cache_timeout - (time.time() - timestamp)
+            if remaining <= 0:
+                self._cache.delete(key)
+                return
+
+            name = basename(path)
+            entry = update(entries.get(name))
+            if entry is None:
+                entries.pop(name, None)
+            else:
+                entries[name] = entry
+            self._cache.set(key, listing, remaining)
+
+    def _list_dir(self, path):
+        """ Entries of a directory by name, including '.' for itself.
+
+            The whole listing is cached as one unit, so listings, wildcard
+            matches and information on any entry are served from it until it
+            expires.
+        """
+        path = abspath(normpath(path))
+        self._settle_dir(path)
+        key = self._listing_key(path)
+        listing = self._cache.get(key)
+        if self.metrics is not None:
+            self.metrics.cache('listing', bool(listing))
+        if listing:
+            return listing[1]
+
+        with self._lookup(path) as store:
+            entries = self._read_dir(path)
+            store(key, (time.time(), entries), self.cache_timeout)
+        return entries
+
+    def _read_dir(self, path):
+        """ Entries of a directory by name, fetched from the server. """
+        with self._connection() as conn:
+            results = _conv_smb_errors(conn.listPath)(self.share, path)
+        return dict((i.filename, SMBInfo.from_shared_file(i))
+                    for i in results if i.filename != '..')
+
+    def _listPath(self, path):
+        """ Information on a path, with SMB errors converted. """
+        path = abspath(normpath(path))
+        self._settle(path)
+        pathdir = dirname(path)
+        searchpath = basename(path) or '.'
+
+        cache_key = self._cache_key(path)
+        listing_key = self._listing_key(pathdir)
+        cached = self._cache.get_many([cache_key, listing_key]) or {}
+
+        cache_read = cached.get(cache_key)
+        if self.metrics is not None:
+            self.metrics.cache('info', cache_read is not None or
+                               bool(cached.get(listing_key)))
+        if cache_read is _CACHED_NOT_FOUND:
+            raise ResourceNotFoundError(path)
+        if cache_read:
+            return cache_read
 
-                    cache_key = "smbcache%s%s%s%s%s%s%s" % (
-                        self.username, self.server_name, self.share,
-                        self.server_IP, self.share,
-                        pathjoin(dirname(folder), basename(result.filename)),
-                        False)
-                    bulk_cache_items[str(cache_key)] = result
+        # A cached listing of the directory knows about every entry.
+        listing = cached.get(listing_key)
+        if listing:
+            result = listing[1].get(searchpath)
+            if result:
+                return result
+            raise ResourceNotFoundError(path)
 
-                # Set cache for each item in the directory
-                self._cache.set_many(bulk_cache_items, 60)
-                return results
+        # Otherwise ask for the attributes of the path alone, which costs the
+        # same whatever the size of the directory.  Should the server refuse,
+        # the path is looked up in the listing of its directory instead.
+        with self._lookup(path) as store:
+            try:
+                result = self._getAttributes(path)
             except ResourceNotFoundError:
-                if self.isfile(path):
-                    raise ResourceInvalidError(path)
+                result = None
+            except RemoteConnectionError:
                 raise
-        else:
-            # List a specific path (file or directory) by listing the contents
-            # of the containing directory and comparing the filename.
-            pathdir = dirname(path)
-            searchpath = basename(path)
-
-            cache_key = "smbcache%s%s%s%s%s%s%s" % (
-                self.username, self.server_name, self.share, self.server_IP,
-                self.share, pathjoin(pathdir, searchpath), False)
-            cache_read = self._cache.get(str(cache_key))
-
-            if cache_read:
-                return cache_read
-
-            results = _conv_smb_errors(self.conn.listPath)(self.share, pathdir)
-
-            bulk_cache_items = {}
-
-            result = None
-
-            for i in results:
-                if i.filename == '..':
-                    continue
-                elif ((i.filename == '.' and searchpath == '') or
-                      i.filename == searchpath):
-                    result = i
-
-                cache_key = "smbcache%s%s%s%s%s%s%s" % (
-                    self.username, self.server_name, self.share,
-                    self.server_IP, self.share,
-                    pathjoin(pathdir, basename(i.filename)), False)
-
-                bulk_cache_items[str(cache_key)] = i
-
-            # Set cache for each item in the directory
-            self._cache.set_many(bulk_cache_items, 60)
+            except FSError:
+                result = self._list_dir(pathdir).get(searchpath)
 
             if result:
+                store(cache_key, result, self.cache_timeout)
                 return result
 
-            raise ResourceNotFoundError(path)
+            # Remember the path does not exist for a shorter time.
+            store(cache_key, _CACHED_NOT_FOUND, self.negative_cache_timeout)
+        raise ResourceNotFoundError(path)
+
+    @_conv_smb_errors
+    def _getAttributes(self, path):
+        """ Information on a single path.  Convert SMB errors. """
+        with self._connection() as conn:
+            info = conn.getAttributes(self.share, path)
+        return SMBInfo.from_shared_file(info, basename(path))
 
     @_conv_smb_errors
     def _retrieveFile(self, path, file_obj):
         """ Retrieve a file.  Convert SMB errors. """
         # Retrieve a file then rewind it to the beginning as pysmb leaves it at
         # the end of the file.
-        self.conn.retrieveFile(self.share, path, file_obj)
+        with self._connection() as conn:
+            conn.retrieveFile(self.share, path, file_obj)
         file_obj.seek(0)
 
+    @_conv_smb_errors
+    def _retrieveFileFromOffset(self, path, file_obj, offset, max_length):
+        """ Retrieve part of a file.  Convert SMB errors. """
+        with self._connection() as conn:
+            conn.retrieveFileFromOffset(self.share, path, file_obj, offset,
+                                        max_length)
+
+    @_conv_smb_errors
+    def _storeFileFromOffset(self, path, file_obj, offset, truncate):
+        """ Store a file at an offset.  Convert SMB errors. """
+        try:
+            with self._connection() as conn:
+                end = conn.storeFileFromOffset(self.share, path, file_obj,
+                                               offset, truncate)
+        except BaseException:
+            self._invalidate(path)
+            raise
+
+        def stored(entry):
+            size = end
+            if entry is not None and not truncate:
+                size = max(size, entry.size)
+            return SMBInfo.new(basename(path), False, size, entry)
+        self._update_listing(path, stored)
+        return end
+
     @_conv_smb_errors
     def _rename(self, src, dst):
         """ Rename a path.  Convert SMB errors. """
-        self.conn.rename(self.share, src, dst)
+        self._settle(src, tree=True)
+        self._settle(dst, tree=True)
+        try:
+            with self._connection() as conn:
+                conn.rename(self.share, src, dst)
+        except BaseException:
+            self._invalidate(src, tree=True)
+            self._invalidate(dst, tree=True)
+            raise
+
+        # Move the entry between the listings if its information is cached.
+        moved = []
+        self._update_listing(src, lambda entry: moved.append(entry), tree=True)
+        if moved and moved[0] is not None:
+            entry = moved[0].renamed(basename(dst))
+            self._update_listing(dst, lambda old: entry, tree=True)
+        else:
+            self._invalidate(dst, tree=True)
 
     @_conv_smb_errors
     def _create_dir(self, path):
         """ Create a directory.  Convert SMB errors. """
-        self.conn.createDirectory(self.share, path)
+        self._settle(path)
+        try:
+            with self._connection() as conn:
+                _conv_smb_errors(conn.createDirectory)(self.share, path)
+        except DestinationExistsError:
+            # Expected of existing directories, so the cache is only fixed
+            # if it took the path for missing.
+            listing = self._cache.get(self._listing_key(dirname(path)))
+            if ((listing and basename(path) not in listing[1]) or
+                    self._cache.get(self._cache_key(path)) is
+                    _CACHED_NOT_FOUND):
+                self._invalidate(path)
+            raise
+        except BaseException:
+            self._invalidate(path)
+            raise
+        self._update_listing(
+            path, lambda entry: SMBInfo.new(basename(path), True, 0))
 
     @_conv_smb_errors
     def _remove_dir(self, path):
         """ Remove a directory.  Convert SMB errors. """
-        self.conn.deleteDirectory(self.share, path)
+        self._settle_dir(path)
+        try:
+            with self._connection() as conn:
+                conn.deleteDirectory(self.share, path)
+        except BaseException:
+            self._invalidate(path, tree=True)
+            raise
+        self._update_listing(path, lambda entry: None, tree=True)
+
+    @_conv_smb_errors
+    def _remove_files(self, path):
+        """ Remove every file in a directory at once.  Convert SMB errors. """
+        try:
+            with self._connection() as conn:
+                conn.deleteFiles(self.share, pathjoin(path, '*'))
+        finally:
+            self._changed(path, tree=True)
+            self._invalidate_below(path)
+
+    def _remove_tree(self, path, progress_callback=None):
+        """ Remove a directory and everything below it. """
+        # The tree is listed first, several directories at a time.
+        dirs = []
+        for dir_path, files in self._walkinfo(path, search='depth',
+                                              ignore_errors=True):
+            dirs.append((dir_path, len(files)))
+
+        removed = [0, 0]
+
+        def progress(files, dirs):
+            removed[0] += files
+            removed[1] += dirs
+            if progress_callback is not None:
+                progress_callback(removed[0], removed[1])
+
+        def remove_files(item):
+            self._remove_files(item[0])
+            return item[1]
+
+        for count in _imap_unordered(remove_files,
+                                     [d for d in dirs if d[1]],
+                                     self.max_connections):
+            progress(count, 0)
+
+        # Then the empty directories, deepest first, each level at once.
+        levels = {}
+        for dir_path, count in dirs:
+            levels.setdefault(dir_path.count('/'), []).append(dir_path)
+        for depth in sorted(levels, reverse=True):
+            for result in _imap_unordered(self._remove_dir, levels[depth],
+                                          self.max_connections):
+                progress(0, 1)
 
-    @synchronize
     @_conv_smb_errors
     @_absnorm_path(1)
     def setcontents(self, path, data=b'', encoding=None, errors=None,
                     chunk_size=1024 * 64, **kwargs):
-        # Remove then write contents.  There is no method to erase the contents
-        # of a file when writing to it using pysmb.
+        if self._write_behind is not None:
+            spool, size = _spool(data, encoding, errors, chunk_size)
+            self._write_behind.put(abspath(normpath(path)), spool, size)
+            return
+        self._replace(path, lambda p: self._store(p, data, encoding, errors,
+                                                  chunk_size))
+
+    def _replace(self, path, store):
+        """ Replace a file with what `store(path)` writes to a path. """
+        if not self.atomic_setcontents:
+            store(path)
+            return
+
+        # Upload under a hidden name in the same directory so readers never
+        # see a partial file, then move it into place.
+        tmp_path = pathjoin(dirname(path), u'.{0}.{1:08x}.tmp'.format(
+            basename(path), random.getrandbits(32)))
+        try:
+            try:
+                store(tmp_path)
+            except FSError as e:
+                e.path = path
+                raise
+            try:
+                self._rename(tmp_path, path)
+            except DestinationExistsError:
+                # A directory is left alone, as in non-atomic mode.
+                if self.isdir(path):
+                    raise ResourceInvalidError(path)
+                # pysmb cannot ask the server to replace an existing file on
+                # rename, so the old one is moved aside until the new one is
+                # in place, and moved back should that fail.
+                old_path = tmp_path[:-len('tmp')] + 'old'
+                self._rename(path, old_path)
+                try:
+                    self._rename(tmp_path, path)
+                except BaseException:
+                    self._rename(old_path, path)
+                    raise
+                self._discard(old_path)
+        except BaseException:
+            # Cleaned up in another frame so Python 2 raises the original
+            # error rather than one swallowed here.
+            self._discard(tmp_path)
+            raise
+
+    def _discard(self, path):
+        """ Remove a file, ignoring any error. """
         try:
             self.remove(path)
-        except ResourceNotFoundError:
+        except FSError:
             pass
 
+    def _store(self, path, data, encoding, errors, chunk_size):
+        """ Replace the contents of a file with a string or file. """
+        if isinstance(data, type(u'')):
+            data = data.encode(encoding or 'utf-8', errors or 'strict')
         if not hasattr(data, 'read'):
-            data = StringIO(data)
-        self.conn.storeFile(self.share, path, data)
+            self._overwrite(path, StringIO(data))
+            return
+
+        # Stream the source to the server in chunks while it is being read.
+        f = SMBWriteFile(self, path, chunk_size, self.write_queue_size)
+        try:
+            chunk = data.read(chunk_size)
+            while chunk:
+                if isinstance(chunk, type(u'')):
+                    chunk = chunk.encode(encoding or 'utf-8',
+                                         errors or 'strict')
+                f.write(chunk)
+                chunk = data.read(chunk_size)
+        finally:
+            f.close()
+
+    def _overwrite(self, path, file_obj):
+        """ Create or truncate a file and store `file_obj` in it.
+
+            The server truncates the file as it opens it, so there is no
+            separate delete.  Windows refuses to truncate hidden or system
+            files this way, so those are removed and created anew.
+        """
+        try:
+            self._storeFileFromOffset(path, file_obj, 0, True)
+        except PermissionDeniedError as e:
+            try:
+                self.remove(path)
+            except FSError:
+                raise e
+            self._storeFileFromOffset(path, file_obj, 0, True)
 
     @property
     @synchronize
-    @_conv_smb_errors
     def conn(self):
-        """ Connection to server. """
+        """ Connection to server.
+
+            Within an operation this is the connection checked out by the
+            current thread.  Otherwise it is a dedicated connection kept for
+            callers using pysmb directly, outside of the pool.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            return conn
         if self._conn is None:
-            self._conn = SMBConnection(
-                self.username, self.password, self.client_name,
-                self.server_name, use_ntlm_v2=True)
-            self._conn.connect(self.server_IP, self.port)
+            self._conn = self._connect()
         return self._conn
 
+    def flush(self):
+        """ Wait for pending write-behind uploads.
+
+            Raises the first error of the uploads since the last flush.
+        """
+        if self._write_behind is not None:
+            self._write_behind.barrier()
+
     @synchronize
     def close(self):
-        super(SMBFS, self).close()
-        if self._conn is not None:
-            self._conn.close()
-            self._conn = None
+        try:
+            self.flush()
+        finally:
+            super(SMBFS, self).close()
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+            if self._leased:
+                session_registry.release(self._session_key())
+                self._leased = False
+            elif not self.shared_sessions:
+                self._pool.clear()
 
-    @synchronize
     @iotools.filelike_to_stream
     @_absnorm_path(1)
     def open(self, path, mode='r', **kwargs):
-        if self.isdir(path):
+        # Reads are streamed from the server, so only the size is needed.
+        # It is looked up afresh as reads stop there.
+        if 'r' in mode and '+' not in mode:
+            try:
+                info = self._fresh_info(path)
+            except ResourceInvalidError:
+                # Part of the path is a file.
+                raise ResourceNotFoundError(path)
+            if info.is_dir:
+                raise ResourceInvalidError(path)
+            if self.content_cache is not None:
+                file_obj = self._open_cached(path, info)
+                if file_obj is not None:
+                    return file_obj
+            return SMBReadFile(
+                self, path, info.size,
+                kwargs.get('block_size') or self.read_block_size,
+                kwargs.get('read_ahead', self.read_ahead))
+
+        # Writes are streamed to the server as they are made, or queued
+        # once the file is closed in write-behind mode.
+        if 'w' in mode and '+' not in mode and self._write_behind is not None:
+            return _WriteBehindFile(self, path,
+                                    kwargs.get('chunk_size') or 1024 * 64)
+        if 'w' in mode and '+' not in mode:
+            return SMBWriteFile(self, path,
+                                kwargs.get('chunk_size') or 1024 * 64,
+                                self.write_queue_size)
+
+        # Other modes read and write ranges of the file in place, appending
+        # at the size found on the server, not a cached one.
+        try:
+            info = self._fresh_info(path)
+        except ResourceInvalidError:
+            raise ResourceNotFoundError(path)
+        except ResourceNotFoundError:
+            if 'r' in mode:
+                raise
+            info = None
+        if info is not None and info.is_dir:
             raise ResourceInvalidError(path)
-
-        # Erase the contents of a file upon write.
-        if 'w' in mode:
-            file_obj = None
-            self.setcontents(path, StringIO())
+        size = 0
+        if info is None or 'w' in mode:
+            self._overwrite(path, io.BytesIO())
         else:
-            file_obj = SpooledTemporaryFile()
-            self._retrieveFile(path, file_obj)
-        return RemoteFileBuffer(self, path, mode, file_obj)
+            size = info.size
+        return SMBRandomAccessFile(
+            self, path, mode, size, kwargs.get('chunk_size') or 1024 * 64,
+            kwargs.get('block_size') or self.read_block_size)
+
+    def _fresh_info(self, path):
+        """ Information on a path from the server rather than the cache. """
+        self._settle(path)
+        with self._lookup(path) as store:
+            try:
+                info = self._getAttributes(path)
+            except (ResourceNotFoundError, RemoteConnectionError):
+                raise
+            except FSError:
+                # The server refuses to tell, so list the directory instead.
+                self._invalidate(path)
+                return self._listPath(path)
+            store(self._cache_key(path), info, self.cache_timeout)
+        return info
+
+    def _open_cached(self, path, info):
+        """ Local copy of a file from the content cache, fetched if needed.
+
+            None if the file is too large to be kept.
+        """
+        key = self._cache_key(path)
+        local_path = self.content_cache.get(key, info.size, info.mtime)
+        if self.metrics is not None:
+            self.metrics.cache('content', local_path is not None)
+        if local_path is None:
+            local_path = self.content_cache.put(
+                key, info.size, info.mtime,
+                lambda f: self._retrieveFileFromOffset(path, f, 0, -1))
+            if local_path is None:
+                return None
+        try:
+            return io.open(local_path, 'rb')
+        except IOError:
+            # Evicted by another thread or process in the meantime.
+            return None
+
+    @_absnorm_path(1)
+    def exists(self, path):
+        try:
+            self._listPath(path)
+            return True
+        except FSError:
+            return False
 
-    @synchronize
     @_absnorm_path(1)
     def isfile(self, path):
         try:
-            return not self._listPath(path).isDirectory
+            return not self._listPath(path).is_dir
         except FSError:
             return False
 
-    @synchronize
     @_absnorm_path(1)
     def isdir(self, path):
         try:
-            return self._listPath(path).isDirectory
+            return self._listPath(path).is_dir
         except FSError:
             return False
 
-    def _conv_smb_info_to_fs(self, smb_info):
-        """ Convert SMB information into PyFilesystem info dict. """
-        return {'size': smb_info.file_size,
-                'st_mode': (stat.S_IFDIR if smb_info.isDirectory else
-                            stat.S_IFREG),
-                'created_time': datetime.datetime.fromtimestamp(
-                    smb_info.create_time),
-                'st_ctime': smb_info.create_time,
-                'accessed_time': datetime.datetime.fromtimestamp(
-                    smb_info.last_access_time),
-                'st_atime': smb_info.last_access_time,
-                'modified_time': datetime.datetime.fromtimestamp(
-                    smb_info.last_write_time),
-                'st_mtime': smb_info.last_write_time}
+    def _iter_dir(self, path, wildcard=None):
+        """ Iterate over the names and information of a directory's entries.
+
+            The directory is listed as a whole and cached, unless the listing
+            is not already cached and `wildcard` can be applied by the
+            server.  Then only the matching entries are fetched and nothing is
+            cached.  Errors are raised when the iteration starts.
+        """
+        path = abspath(normpath(path))
+        self._settle_dir(path)
+        pattern = _server_pattern(wildcard)
+        if pattern is None or self._cache.get(self._listing_key(path)):
+            entries = self._list_dir(path)
+            # Names are copied so the listing can be patched meanwhile.
+            for name in list(entries):
+                info = entries.get(name)
+                if info is not None and name != '.':
+                    yield name, info
+            return
+
+        try:
+            with self._connection() as conn:
+                results = _conv_smb_errors(conn.listPath)(
+                    self.share, path, pattern=pattern)
+        except ResourceNotFoundError:
+            # Older pysmb reports an empty match as a missing file.
+            if not self.isdir(path):
+                raise
+            results = []
+        for i in results:
+            if i.filename != '.' and i.filename != '..':
+                yield i.filename, SMBInfo.from_shared_file(i)
+
+    def _ilistdirinfo(self, path, wildcard=None, full=False, absolute=False,
+                      dirs_only=False, files_only=False):
+        """ Iterate over the names and SMBInfo of a directory's entries. """
+        if dirs_only and files_only:
+            raise ValueError("dirs_only and files_only can not both be True")
+        match = _wildcard_matcher(wildcard)
+        prefix = None
+        if full:
+            prefix = normpath(path)
+        elif absolute:
+            prefix = abspath(normpath(path))
+
+        try:
+            for name, info in self._iter_dir(path, wildcard):
+                # Skip undesired types and names.
+                if ((dirs_only and not info.is_dir) or
+                        (files_only and info.is_dir) or
+                        (match is not None and not match(name))):
+                    continue
+                if prefix is not None:
+                    name = pathcombine(prefix, name)
+                yield name, info
+        except ResourceNotFoundError:
+            if self.isfile(path):
+                raise ResourceInvalidError(path)
+            raise
+
+    def ilistdirinfo(self, path="./", wildcard=None, full=False,
+                     absolute=False, dirs_only=False, files_only=False):
+        for name, info in self._ilistdirinfo(path, wildcard, full, absolute,
+                                             dirs_only, files_only):
+            yield name, info.copy()
 
-    @synchronize
     def listdirinfo(self, path="./", wildcard=None, full=False, absolute=False,
                     dirs_only=False, files_only=False):
-        listing = []
-        for i in self._listPath(path, list_contents=True):
-            # Skip ., .. and undesired types.
-            if (i.filename == '.' or i.filename == '..' or
-                (dirs_only and not i.isDirectory) or
-                (files_only and i.isDirectory)):
-                continue
+        return list(self.ilistdirinfo(path, wildcard, full, absolute,
+                                      dirs_only, files_only))
 
-            # Rely on the PyFilesystem helper to determine if the path should
-            # be listed.  An empty listing indicates to not list the path.
-            name = self._listdir_helper(path, [i.filename], wildcard, full,
-                                        absolute, False, False)
-            if len(name) == 1:
-                listing.append((name[0], self._conv_smb_info_to_fs(i)))
-        return listing
+    def ilistdir(self, path="./", wildcard=None, full=False, absolute=False,
+                 dirs_only=False, files_only=False):
+        # Wrap whatever _ilistdirinfo yields while discarding the info.
+        for name, info in self._ilistdirinfo(path, wildcard, full, absolute,
+                                             dirs_only, files_only):
+            yield name
 
-    @synchronize
     def listdir(self, path="./", wildcard=None, full=False, absolute=False,
                 dirs_only=False, files_only=False):
-        # Wrap whatever listdirinfo returns while discarding the info.
-        return [name[0] for name in self.listdirinfo(
-            path, wildcard, full, absolute, dirs_only, files_only)]
+        # Wrap whatever ilistdir yields.
+        return list(self.ilistdir(path, wildcard, full, absolute, dirs_only,
+                                  files_only))
 
-    @synchronize
     def makedir(self, path, recursive=False, allow_recreate=False):
         # Create a directory from the top downwards depending upon the flags.
         paths = recursepath(path) if recursive else (path, )
@@ -499,27 +2681,145 @@ class SMBFS(FS):
                 e.path = path
                 raise
 
-    @synchronize
     @_conv_smb_errors
     @_absnorm_path(1)
     def remove(self, path, **kwargs):
-        self.conn.deleteFiles(self.share, path)
+        self._settle(path)
+        try:
+            with self._connection() as conn:
+                conn.deleteFiles(self.share, path)
+        except BaseException:
+            self._invalidate(path)
+            raise
+        self._update_listing(path, lambda entry: None)
+
+    def walk(self, path='/', wildcard=None, dir_wildcard=None,
+             search='breadth', ignore_errors=False):
+        # Wrap whatever _walkinfo returns while discarding the info.
+        for dir_path, files in self._walkinfo(path, wildcard, dir_wildcard,
+                                              search, ignore_errors):
+            yield dir_path, [name for name, info in files]
+
+    def walkinfo(self, path='/', wildcard=None, dir_wildcard=None,
+                 search='breadth', ignore_errors=False, max_workers=None):
+        """ Walk a directory tree, listing several directories at once.
+
+            Like walk(), but the files of each directory are listed as
+            `(name, info)` with the information from the listing.  Up to
+            `max_workers` directories are listed at the same time, by
+            default as many as there are connections.  Directories are
+            yielded as their listings arrive; with "breadth" search a
+            directory comes before its subdirectories and with "depth"
+            search after them.  `dir_wildcard` is matched against the path
+            of each subdirectory and `wildcard` against the file names.
+        """
+        for dir_path, files in self._walkinfo(path, wildcard, dir_wildcard,
+                                              search, ignore_errors,
+                                              max_workers):
+            yield dir_path, [(name, info.copy()) for name, info in files]
+
+    def _walkinfo(self, path, wildcard=None, dir_wildcard=None,
+                  search='breadth', ignore_errors=False, max_workers=None):
+        """ Walk a directory tree like walkinfo(), listing SMBInfo. """
+        if search not in ('breadth', 'depth'):
+            raise ValueError("Search should be 'breadth' or 'depth'")
+        path = abspath(normpath(path))
+        if not self.exists(path):
+            raise ResourceNotFoundError(path)
+        wildcard = _wildcard_matcher(wildcard)
+        dir_wildcard = _wildcard_matcher(dir_wildcard)
+        max_workers = max_workers or self.max_connections
+
+        requests = queue.Queue()
+        results = queue.Queue()
+
+        def list_dirs():
+            while True:
+                dir_path = requests.get()
+                if dir_path is None:
+                    return
+                try:
+                    entries = list(self._ilistdirinfo(dir_path))
+                    results.put((dir_path, entries, None))
+                except Exception as e:
+                    results.put((dir_path, [], e))
+
+        workers = [threading.Thread(target=list_dirs)
+                   for i in range(max_workers)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        # Directories waiting to be listed, taken oldest first for breadth
+        # search and newest first for depth search to keep this short.
+        pending = deque([path])
+        listing = 0
+        # Directories listed but waiting on their subdirectories, with the
+        # number of those left and the files to yield.
+        waiting = {}
+        try:
+            while pending or listing:
+                while pending and listing < max_workers:
+                    requests.put(pending.popleft() if search == 'breadth'
+                                 else pending.pop())
+                    listing += 1
+                dir_path, entries, error = results.get()
+                listing -= 1
+
+                # Directories removed while walking are skipped.
+                if (error is not None and not ignore_errors and
+                        (dir_path == path or
+                         not isinstance(error, ResourceNotFoundError))):
+                    raise error
+
+                files = []
+                subdirs = []
+                for name, info in entries:
+                    if info.is_dir:
+                        subdir = pathjoin(dir_path, name)
+                        if dir_wildcard is None or dir_wildcard(subdir):
+                            subdirs.append(subdir)
+                    elif wildcard is None or wildcard(name):
+                        files.append((name, info))
+                pending.extend(subdirs)
+
+                if search == 'breadth':
+                    yield dir_path, files
+                    continue
+
+                # Yield the directory once its subdirectories are done, then
+                # each parent this completes.
+                waiting[dir_path] = [len(subdirs), files]
+                while waiting[dir_path][0] == 0:
+                    yield dir_path, waiting.pop(dir_path)[1]
+                    if dir_path == path:
+                        break
+                    dir_path = dirname(dir_path)
+                    waiting[dir_path][0] -= 1
+        finally:
+            for worker in workers:
+                requests.put(None)
 
-    @synchronize
     @_conv_smb_errors
     @_absnorm_path(1)
-    def removedir(self, path, recursive=False, force=False):
+    def removedir(self, path, recursive=False, force=False,
+                  progress_callback=None):
+        """ Remove a directory.
+
+            With `force`, the whole tree below it is removed: the files of
+            each directory with one wildcard delete and the directories a
+            level at a time from the bottom, several at once.
+            `progress_callback`, if given, is called with the number of files
+            and of directories removed so far as the removal progresses.
+        """
         if path == '/':
             raise RemoveRootError(path)
+        self._settle(path, tree=True)
 
         # Remove directory tree from the bottom upwards depending upon the
         # flags.
         if force:
-            for (del_dir, del_files) in self.walk(path, search='depth',
-                                                  ignore_errors=True):
-                for f in del_files:
-                    self.remove(pathjoin(del_dir, f))
-                self.removedir(del_dir)
+            self._remove_tree(path, progress_callback)
         elif recursive:
             paths = recursepath(path, reverse=True)[:-1]
             for p in paths:
@@ -527,13 +2827,554 @@ class SMBFS(FS):
         else:
             self._remove_dir(path)
 
-    @synchronize
     @_absnorm_path(2)
     @_determine_cause
     def rename(self, src, dst):
         self._rename(src, dst)
 
-    @synchronize
+    @_absnorm_path(2)
+    def copy(self, src, dst, overwrite=False, chunk_size=1024 * 64):
+        """ Copy a file within the share.
+
+            pysmb offers no server-side copy, so the file is downloaded in
+            blocks while it is uploaded in the background, with at most
+            `write_queue_size` chunks of `chunk_size` bytes queued.
+        """
+        try:
+            is_dir = self._listPath(src).is_dir
+        except ResourceInvalidError:
+            raise ResourceNotFoundError(src)
+        if is_dir:
+            raise ResourceInvalidError(src,
+                                       msg="Source is not a file: %(path)s")
+        if not overwrite and self.exists(dst):
+            raise DestinationExistsError(dst)
+        # Opening the destination would truncate the source.
+        if src == dst:
+            return
+
+        try:
+            if src.lower() == dst.lower():
+                # The same file if the share ignores case, so it is read
+                # whole before it is written.
+                spool = SpooledTemporaryFile(max_size=_SMALL_FILE_SIZE)
+                try:
+                    self._retrieveFile(src, spool)
+                    self._overwrite(dst, spool)
+                finally:
+                    spool.close()
+            else:
+                self._copy(src, dst, chunk_size)
+        except ResourceNotFoundError:
+            if not self.isdir(dirname(dst)):
+                raise ParentDirectoryMissingError(dst)
+            raise
+
+    def _copy(self, src, dst, chunk_size):
+        """ Copy the contents of a file to another. """
+        # Blocks are fetched one request at a time so no connection is held
+        # while the upload waits for one.
+        src_file = SMBReadFile(self, src, self._getAttributes(src).size,
+                               self.read_block_size, self.read_ahead)
+        dst_file = SMBWriteFile(self, dst, chunk_size, self.write_queue_size)
+        try:
+            chunk = src_file.read(chunk_size)
+            while chunk:
+                dst_file.write(chunk)
+                chunk = src_file.read(chunk_size)
+        finally:
+            try:
+                dst_file.close()
+            finally:
+                src_file.close()
+
+    @_absnorm_path(2)
+    def copydir(self, src, dst, overwrite=False, ignore_errors=False,
+                chunk_size=16384):
+        """ Copy a directory tree within the share.
+
+            The tree is listed several directories at a time and its files
+            are copied as copy() does, several at once.
+        """
+        if not self.isdir(src):
+            raise ResourceInvalidError(
+                src, msg="Source is not a directory: %(path)s")
+        if not overwrite and self.exists(dst):
+            raise DestinationExistsError(dst)
+        self.makedir(dst, allow_recreate=True)
+
+        files = self._mirror_dirs(src, dst)[1]
+
+        def copy_file(paths):
+            try:
+                self.copy(paths[0], paths[1], overwrite, chunk_size)
+            except FSError:
+                if not ignore_errors:
+                    raise
+
+        # Each copy uses two connections.
+        for result in _imap_unordered(copy_file, files,
+                                      max(1, self.max_connections // 2)):
+            pass
+
+    def _mirror_dirs(self, src, dst):
+        """ Create the directories of a tree under another directory.
+
+            Returns the paths of the directories in the tree, parents first,
+            and the pairs of source and destination paths of its files.
+        """
+        dirs = []
+        files = []
+        for dir_path, entries in self._walkinfo(src):
+            dst_dir = pathjoin(dst, relpath(frombase(src, dir_path)))
+            self.makedir(dst_dir, allow_recreate=True, recursive=True)
+            dirs.append(dir_path)
+            files.extend((pathjoin(dir_path, name), pathjoin(dst_dir, name))
+                         for name, info in entries)
+        return dirs, files
+
+    @_absnorm_path(2)
+    def move(self, src, dst, overwrite=False, chunk_size=16384):
+        """ Move a file within the share with a rename. """
+        try:
+            is_dir = self._listPath(src).is_dir
+        except ResourceInvalidError:
+            raise ResourceNotFoundError(src)
+        if is_dir:
+            raise ResourceInvalidError(src,
+                                       msg="Source is not a file: %(path)s")
+
+        try:
+            self.rename(src, dst)
+        except DestinationExistsError:
+            if not overwrite:
+                raise
+            # pysmb cannot ask the server to replace the file on rename.
+            self.remove(dst)
+            self.rename(src, dst)
+
+    @_absnorm_path(2)
+    def movedir(self, src, dst, overwrite=False, ignore_errors=False,
+                chunk_size=16384):
+        """ Move a directory tree within the share.
+
+            This is a single rename, unless `overwrite` merges the tree into
+            an existing directory.  Then each file is moved into place with
+            a rename, several at once.
+        """
+        if not self.isdir(src):
+            if self.isfile(src):
+                raise ResourceInvalidError(
+                    src, msg="Source is not a directory: %(path)s")
+            raise ResourceNotFoundError(src)
+
+        try:
+            self.rename(src, dst)
+            return
+        except DestinationExistsError:
+            if not overwrite:
+                raise
+
+        dirs, files = self._mirror_dirs(src, dst)
+
+        def move_file(paths):
+            try:
+                self.move(paths[0], paths[1], overwrite=True)
+            except FSError:
+                if not ignore_errors:
+                    raise
+
+        for result in _imap_unordered(move_file, files,
+                                      self.max_connections):
+            pass
+
+        # Remove the emptied directories, children first.
+        for dir_path in reversed(dirs):
+            try:
+                self._remove_dir(dir_path)
+            except FSError:
+                if not ignore_errors:
+                    raise
+
     @_absnorm_path(1)
     def getinfo(self, path):
-        return self._conv_smb_info_to_fs(self._listPath(path))
+        return self._listPath(path).copy()
+
+    def getinfo_many(self, paths, max_workers=None):
+        """ Information on many paths, looked up a directory at a time.
+
+            Returns a dict mapping each path to its information, or to the
+            FSError looking it up raised.  Paths are grouped by directory and
+            each group is answered by one listing of the directory, or by one
+            attribute query for a lone path.  Up to `max_workers` groups,
+            by default as many as there are connections, are looked up at
+            the same time.
+        """
+        groups = {}
+        for path in paths:
+            abs_path = abspath(normpath(path))
+            groups.setdefault(dirname(abs_path), []).append((path, abs_path))
+
+        def lookup(group):
+            dir_path, members = group
+            if len(members) == 1:
+                path, abs_path = members[0]
+                try:
+                    return [(path, self._listPath(abs_path).copy())]
+                except FSError as e:
+                    return [(path, e)]
+
+            try:
+                entries = self._list_dir(dir_path)
+            except (ResourceNotFoundError, ResourceInvalidError):
+                return [(path, ResourceNotFoundError(path))
+                        for path, abs_path in members]
+            except FSError as e:
+                return [(path, e) for path, abs_path in members]
+
+            results = []
+            for path, abs_path in members:
+                info = entries.get(basename(abs_path) or '.')
+                if info is None:
+                    results.append((path, ResourceNotFoundError(path)))
+                else:
+                    results.append((path, info.copy()))
+            return results
+
+        infos = {}
+        for results in _imap_unordered(lookup, groups.items(),
+                                       max_workers or self.max_connections):
+            infos.update(results)
+        return infos
+
+    def exists_many(self, paths, max_workers=None):
+        """ Whether each of many paths exists, as a dict.
+
+            Paths are looked up like getinfo_many() does.
+        """
+        return dict((path, not isinstance(info, FSError))
+                    for path, info in self.getinfo_many(
+                        paths, max_workers).items())
+
+    def watch(self, path='/', interval=5, recursive=True, max_workers=None):
+        """ Poll a directory for changes, yielding fs.watch events.
+
+            A snapshot of the name, size and modification time of the
+            entries of each directory is taken now.  Every `interval`
+            seconds each directory is looked up and only those whose own
+            modification time changed are listed again and compared with
+            their snapshot, on up to `max_workers` connections at once.
+            CREATED, MODIFIED and REMOVED events are yielded for the files
+            and directories that changed, with `recursive` in the whole
+            tree.  Servers update the time of a directory when entries are
+            added, removed or renamed, so a file rewritten in place is only
+            seen as modified once its directory changes.
+        """
+        path = abspath(normpath(path))
+        max_workers = max_workers or self.max_connections
+        # Modification time and (is_dir, size, mtime) of each entry by name
+        # of every directory watched.
+        snapshots = {}
+
+        def poll(dir_path):
+            try:
+                mtime = self._getAttributes(dir_path).mtime
+                snapshot = snapshots.get(dir_path)
+                if snapshot is not None and snapshot[0] == mtime:
+                    return dir_path, None
+                entries = dict((name, (info.is_dir, info.size, info.mtime))
+                               for name, info in self._read_dir(
+                                   dir_path).items() if name != '.')
+            except ResourceNotFoundError:
+                if dir_path == path:
+                    raise
+                # Removed, which the listing of its parent tells.
+                return dir_path, None
+            return dir_path, (mtime, entries)
+
+        def forget(dir_path):
+            """ REMOVED events for everything below a removed directory. """
+            for name, state in snapshots.pop(dir_path, (None, {}))[1].items():
+                child = pathjoin(dir_path, name)
+                if state[0]:
+                    for event in forget(child):
+                        yield event
+                yield REMOVED(self, child)
+
+        def scan(dirs):
+            while dirs:
+                new_dirs = []
+                for dir_path, snapshot in _imap_unordered(poll, dirs,
+                                                          max_workers):
+                    if snapshot is None:
+                        continue
+                    old = snapshots.get(dir_path, (None, {}))[1]
+                    snapshots[dir_path] = snapshot
+                    for name, state in snapshot[1].items():
+                        child = pathjoin(dir_path, name)
+                        before = old.get(name)
+                        if before is not None and before[0] != state[0]:
+                            # Replaced by an entry of the other type.
+                            for event in forget(child):
+                                yield event
+                            yield REMOVED(self, child)
+                            before = None
+                        if before is None:
+                            yield CREATED(self, child)
+                            if state[0] and recursive:
+                                new_dirs.append(child)
+                        elif before != state and not state[0]:
+                            yield MODIFIED(self, child, data_changed=True)
+                    for name, state in old.items():
+                        if name not in snapshot[1]:
+                            child = pathjoin(dir_path, name)
+                            for event in forget(child):
+                                yield event
+                            yield REMOVED(self, child)
+                dirs = new_dirs
+
+        # Events of the first scan describe the initial state.
+        for event in scan([path]):
+            pass
+
+        def events():
+            while True:
+                time.sleep(interval)
+                for event in scan(sorted(snapshots)):
+                    yield event
+        return events()
+
+    @_absnorm_path(1)
+    def download(self, path, local_path, part_size=None, max_workers=None):
+        """ Copy a file of the share to a local path.
+
+            The file is split into parts of `part_size` bytes, by default
+            `download_part_size`, fetched with ranged requests on up to
+            `max_workers` connections at once and written straight into the
+            local file at their offsets.
+        """
+        # The size is asked of the server, as a cached one may be stale.
+        path = abspath(normpath(path))
+        info = self._fresh_info(path)
+        if info.is_dir:
+            raise ResourceInvalidError(path)
+        part_size = part_size or self.download_part_size
+        parts = [(offset, min(part_size, info.size - offset))
+                 for offset in range(0, info.size, part_size)]
+        lock = threading.Lock()
+
+        with open(local_path, 'wb') as f:
+            f.truncate(info.size)
+
+            def fetch(part):
+                offset, length = part
+                self._retrieveFileFromOffset(
+                    path, _OffsetWriter(f, lock, offset), offset, length)
+
+            for _ in _imap_unordered(fetch, parts,
+                                     max_workers or self.max_connections):
+                pass
+
+    def upload_tree(self, local_dir, remote_dir, max_workers=None,
+                    max_bytes_per_second=None, progress_callback=None):
+        """ Copy a local directory tree into a directory of the share.
+
+            Files are uploaded on up to `max_workers` connections at once,
+            by default all of them.  Large files are streamed from disk and
+            small files are sent in batches, each batch on one connection.
+            `max_bytes_per_second` caps the total rate.  `progress_callback`,
+            if given, is called with the number of files and bytes done so
+            far and the totals as each batch completes.
+        """
+        remote_dir = abspath(normpath(remote_dir))
+        transfers = []
+        for dir_path, dir_names, file_names in os.walk(local_dir):
+            rel_dir = os.path.relpath(dir_path, local_dir)
+            remote_path = remote_dir
+            if rel_dir != os.curdir:
+                remote_path = pathjoin(remote_dir,
+                                       *rel_dir.split(os.sep))
+            self.makedir(remote_path, recursive=True, allow_recreate=True)
+            for name in file_names:
+                local_path = os.path.join(dir_path, name)
+                transfers.append((local_path, pathjoin(remote_path, name),
+                                  os.path.getsize(local_path)))
+
+        def upload(local_path, remote_path, limiter):
+            with open(local_path, 'rb') as f:
+                if limiter is not None:
+                    f = _ThrottledFile(f, limiter)
+                self._overwrite(remote_path, f)
+
+        self._transfer(upload, transfers, max_workers, max_bytes_per_second,
+                       progress_callback)
+
+    def download_tree(self, remote_dir, local_dir, max_workers=None,
+                      max_bytes_per_second=None, progress_callback=None):
+        """ Copy a directory tree of the share into a local directory.
+
+            The counterpart of upload_tree(), taking the same options.  The
+            tree is listed several directories at a time.
+        """
+        remote_dir = abspath(normpath(remote_dir))
+        transfers = []
+        for dir_path, files in self._walkinfo(remote_dir):
+            local_path = local_dir
+            if dir_path != remote_dir:
+                local_path = os.path.join(local_dir, *relpath(
+                    frombase(remote_dir, dir_path)).split('/'))
+            if not os.path.isdir(local_path):
+                os.makedirs(local_path)
+            for name, info in files:
+                transfers.append((os.path.join(local_path, name),
+                                  pathjoin(dir_path, name), info.size))
+
+        def download(local_path, remote_path, limiter):
+            with open(local_path, 'wb') as f:
+                if limiter is not None:
+                    f = _ThrottledFile(f, limiter)
+                self._retrieveFileFromOffset(remote_path, f, 0, -1)
+
+        self._transfer(download, transfers, max_workers,
+                       max_bytes_per_second, progress_callback)
+
+    def sync_tree(self, remote_dir, local_dir, manifest_path=None,
+                  delete=True, max_workers=None, max_bytes_per_second=None,
+                  progress_callback=None):
+        """ Bring a local copy of a directory tree of the share up to date.
+
+            Only files that are new or whose size or modification time
+            changed since the last sync are downloaded, so a share that
+            barely changed costs one listing of its tree.  Files are
+            compared with the manifest at `manifest_path`, written by the
+            previous sync, or else with the local files.  With `delete`,
+            local files no longer on the share are removed.  Other options
+            are those of download_tree().
+
+            Returns the numbers of files downloaded, removed and left
+            unchanged in a dict.
+        """
+        remote_dir = abspath(normpath(remote_dir))
+        old = None
+        if manifest_path is not None:
+            old = _load_manifest(manifest_path)
+        new = {}
+        remote_dirs = set([u''])
+        remote_files = set()
+        transfers = []
+
+        def local(rel):
+            if not rel:
+                return local_dir
+            return os.path.join(local_dir, *rel.split('/'))
+
+        def download(local_path, remote_path, limiter):
+            with open(local_path, 'wb') as f:
+                if limiter is not None:
+                    f = _ThrottledFile(f, limiter)
+                self._retrieveFileFromOffset(remote_path, f, 0, -1)
+
+        def downloaded(batch):
+            for local_path, remote_path, size, rel, mtime in batch:
+                os.utime(local_path, (mtime, mtime))
+                new[rel] = (size, mtime)
+
+        try:
+            for dir_path, files in self._walkinfo(remote_dir):
+                rel_dir = relpath(frombase(remote_dir, dir_path))
+                remote_dirs.add(rel_dir)
+                if not os.path.isdir(local(rel_dir)):
+                    os.makedirs(local(rel_dir))
+                for name, info in files:
+                    rel = pathjoin(rel_dir, name) if rel_dir else name
+                    local_path = local(rel)
+                    if old is None:
+                        remote_files.add(rel)
+                        same = _same_local_file(local_path, info.size,
+                                                info.mtime)
+                    else:
+                        same = old.pop(rel, None) == (info.size, info.mtime)
+                    if same:
+                        new[rel] = (info.size, info.mtime)
+                    else:
+                        transfers.append((local_path,
+                                          pathjoin(dir_path, name),
+                                          info.size, rel, info.mtime))
+            unchanged = len(new)
+
+            if old is not None:
+                stale = list(old)
+            else:
+                stale = []
+                for dir_path, dir_names, file_names in os.walk(local_dir):
+                    rel_dir = os.path.relpath(dir_path, local_dir)
+                    parts = [] if rel_dir == os.curdir else rel_dir.split(
+                        os.sep)
+                    for name in file_names:
+                        rel = '/'.join(parts + [name])
+                        if rel not in remote_files:
+                            stale.append(rel)
+            removed = 0
+            if delete:
+                for rel in stale:
+                    try:
+                        os.remove(local(rel))
+                    except OSError:
+                        if os.path.exists(local(rel)):
+                            raise
+                    else:
+                        removed += 1
+                    if old is not None:
+                        del old[rel]
+                    # Prune directories left empty that the share lost too.
+                    rel_dir = dirname(rel)
+                    while rel_dir not in remote_dirs:
+                        try:
+                            os.rmdir(local(rel_dir))
+                        except OSError:
+                            break
+                        rel_dir = dirname(rel_dir)
+
+            self._transfer(download, transfers, max_workers,
+                           max_bytes_per_second, progress_callback,
+                           downloaded)
+        finally:
+            if manifest_path is not None:
+                # Files not seen or not removed yet keep their entries so
+                # an interrupted sync picks up where it stopped.
+                new.update(old)
+                _save_manifest(manifest_path, new)
+        return {'downloaded': len(transfers), 'removed': removed,
+                'unchanged': unchanged}
+
+    def _transfer(self, transfer, transfers, max_workers,
+                  max_bytes_per_second, progress_callback,
+                  batch_callback=None):
+        """ Run `transfer(local_path, remote_path, limiter)` for each file.
+
+            Small files are batched so a batch keeps one connection.
+            `batch_callback`, if given, is called with each batch of
+            `transfers` once it is done.
+        """
+        limiter = None
+        if max_bytes_per_second:
+            limiter = _RateLimiter(max_bytes_per_second)
+        total_files = len(transfers)
+        total_bytes = sum(t[2] for t in transfers)
+
+        def run(batch):
+            with self._connection():
+                for t in batch:
+                    transfer(t[0], t[1], limiter)
+            return batch
+
+        done_files = done_bytes = 0
+        for batch in _imap_unordered(run, _batch_transfers(transfers),
+                                     max_workers or self.max_connections):
+            if batch_callback is not None:
+                batch_callback(batch)
+            done_files += len(batch)
+            done_bytes += sum(t[2] for t in batch)
+            if progress_callback is not None:
+                progress_callback(done_files, total_files, done_bytes,
+                                  total_bytes)
@@ -0,0 +1,169 @@
+""" asyncio front end to SMBFS.
+
+    Requires Python 3.6 or later.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+
+def _delegate(name):
+    """ Coroutine method running the SMBFS method `name` off the loop. """
+    async def method(self, *args, **kwargs):
+        return await self._run(getattr(self.fs, name), *args, **kwargs)
+    method.__name__ = name
+    method.__doc__ = 'Awaitable SMBFS.{0}().'.format(name)
+    return method
+
+
+class AsyncSMBFile(object):
+    """ File opened by AsyncSMBFS.open(), with awaitable methods.
+
+        A file must not be used by several coroutines at the same time.
+    """
+
+    def __init__(self, afs, file_obj):
+        self._afs = afs
+        self._file = file_obj
+        self.name = getattr(file_obj, 'name', None)
+        self.mode = getattr(file_obj, 'mode', None)
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+    async def read(self, size=-1):
+        return await self._afs._run(self._file.read, size)
+
+    async def write(self, data):
+        return await self._afs._run(self._file.write, data)
+
+    async def seek(self, offset, whence=0):
+        return await self._afs._run(self._file.seek, offset, whence)
+
+    async def tell(self):
+        return await self._afs._run(self._file.tell)
+
+    async def truncate(self, size=None):
+        return await self._afs._run(self._file.truncate, size)
+
+    async def flush(self):
+        return await self._afs._run(self._file.flush)
+
+    async def close(self):
+        return await self._afs._run(self._file.close)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+
+class _Opening(object):
+    """ Result of AsyncSMBFS.open(), to await or to use with `async with`. """
+
+    def __init__(self, coro):
+        self._coro = coro
+        self._file = None
+
+    def __await__(self):
+        return self._coro.__await__()
+
+    async def __aenter__(self):
+        self._file = await self._coro
+        return self._file
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self._file.close()
+
+
+class AsyncSMBFS(object):
+    """ Awaitable interface to an SMBFS.
+
+        Each call runs the matching SMBFS method on one of `max_workers`
+        threads, by default as many as the filesystem has connections, so
+        any number of coroutines share its bounded connection pool and
+        errors are the same PyFilesystem errors SMBFS raises.
+    """
+
+    def __init__(self, fs, max_workers=None):
+        self.fs = fs
+        self._executor = ThreadPoolExecutor(max_workers or fs.max_connections)
+
+    def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self._executor,
+                                    partial(func, *args, **kwargs))
+
+    exists = _delegate('exists')
+    isdir = _delegate('isdir')
+    isfile = _delegate('isfile')
+    getinfo = _delegate('getinfo')
+    getsize = _delegate('getsize')
+    listdir = _delegate('listdir')
+    listdirinfo = _delegate('listdirinfo')
+    getcontents = _delegate('getcontents')
+    setcontents = _delegate('setcontents')
+    makedir = _delegate('makedir')
+    remove = _delegate('remove')
+    removedir = _delegate('removedir')
+    rename = _delegate('rename')
+    copy = _delegate('copy')
+    move = _delegate('move')
+
+    def open(self, path, mode='r', **kwargs):
+        """ Open a file, awaited or used with `async with`. """
+        return _Opening(self._open(path, mode, **kwargs))
+
+    async def _open(self, path, mode, **kwargs):
+        file_obj = await self._run(self.fs.open, path, mode, **kwargs)
+        return AsyncSMBFile(self, file_obj)
+
+    async def ilistdirinfo(self, path='./', wildcard=None, full=False,
+                           absolute=False, dirs_only=False, files_only=False):
+        """ Asynchronous iterator over listdirinfo(). """
+        # The server sends a listing in one reply, so it is fetched whole.
+        for item in await self.listdirinfo(path, wildcard, full, absolute,
+                                           dirs_only, files_only):
+            yield item
+
+    async def ilistdir(self, path='./', wildcard=None, full=False,
+                       absolute=False, dirs_only=False, files_only=False):
+        """ Asynchronous iterator over listdir(). """
+        for name in await self.listdir(path, wildcard, full, absolute,
+                                       dirs_only, files_only):
+            yield name
+
+    async def walkinfo(self, path='/', wildcard=None, dir_wildcard=None,
+                       search='breadth', ignore_errors=False,
+                       max_workers=None):
+        """ Asynchronous iterator over SMBFS.walkinfo(). """
+        walker = self.fs.walkinfo(path, wildcard, dir_wildcard, search,
+                                  ignore_errors, max_workers)
+        done = object()
+        try:
+            while True:
+                item = await self._run(next, walker, done)
+                if item is done:
+                    break
+                yield item
+        finally:
+            await self._run(walker.close)
+
+    async def walk(self, path='/', wildcard=None, dir_wildcard=None,
+                   search='breadth', ignore_errors=False):
+        """ Asynchronous iterator over SMBFS.walk(). """
+        async for dir_path, files in self.walkinfo(
+                path, wildcard, dir_wildcard, search, ignore_errors):
+            yield dir_path, [name for name, info in files]
+
+    async def close(self):
+        await self._run(self.fs.close)
+        self._executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
@@ -1,10 +1,51 @@
 """ Unit tests for smbfs. """
+import datetime
+import gc
+import itertools
+import os
+import pickle
+import shutil
+import tempfile
+import smbfs
+import socket
+import stat
+import threading
+import time
 import unittest
+import weakref
 
+from smb.base import SharedFile
+from smb.smb_constants import ATTR_ARCHIVE
+from smb.smb_constants import ATTR_DIRECTORY
+
+from fs.errors import DestinationExistsError
+from fs.errors import DirectoryNotEmptyError
+from fs.errors import FSError
+from fs.errors import RemoteConnectionError
+from fs.errors import ResourceInvalidError
+from fs.errors import ResourceNotFoundError
+from fs.path import dirname
 from fs.tests import FSTestCases
 from fs.tests import ThreadingTestCases
 
+from smbfs import ContentCache
+from smbfs import LRUCacheBackend
+from smbfs import MetricsCollector
+from smbfs import SMBConnectionPool
 from smbfs import SMBFS
+from smbfs import SMBInfo
+from smbfs import SMBReadFile
+from smbfs import SMBSessionRegistry
+from smbfs import SMBWriteFile
+from smbfs.tests.fakesmb import FakeSMBConnection
+from smbfs.tests.fakesmb import FakeSMBServer
+from smbfs.tests.fakesmb import _failure
+
+try:
+    import asyncio
+    from smbfs.aio import AsyncSMBFS
+except (ImportError, SyntaxError):
+    AsyncSMBFS = None
 
 
 class TestSMBFS(FSTestCases, ThreadingTestCases, unittest.TestCase):
@@ -23,3 +64,1107 @@ class TestSMBFS(FSTestCases, ThreadingTestCases, unittest.TestCase):
     def tearDown(self):
         super(TestSMBFS, self).tearDown()
         self.fs.close()
+
+
+class DummyConnection(object):
+    """ Stand-in for an SMBConnection that only tracks its state. """
+
+    def __init__(self):
+        self.sock = object()
+
+    def echo(self, data):
+        if self.sock is None:
+            raise socket.error('closed')
+        return data
+
+    def close(self):
+        self.sock = None
+
+
+class TestSMBConnectionPool(unittest.TestCase):
+    """ Checkout, reuse and replacement of pooled connections. """
+
+    def setUp(self):
+        self.created = []
+        self.pool = SMBConnectionPool(self.factory, max_size=2)
+
+    def factory(self):
+        conn = DummyConnection()
+        self.created.append(conn)
+        return conn
+
+    def test_reuse(self):
+        with self.pool.connection() as conn1:
+            pass
+        with self.pool.connection() as conn2:
+            pass
+        self.assertIs(conn1, conn2)
+        self.assertEqual(len(self.created), 1)
+
+    def test_bounded(self):
+        conn1 = self.pool.checkout()
+        conn2 = self.pool.checkout()
+        self.assertIsNot(conn1, conn2)
+        self.assertRaises(RemoteConnectionError, self.pool.checkout, 0.01)
+
+        # A waiting caller gets the connection as soon as it is checked in.
+        result = []
+        waiter = threading.Thread(
+            target=lambda: result.append(self.pool.checkout(5)))
+        waiter.start()
+        self.pool.checkin(conn1)
+        waiter.join()
+        self.assertEqual(result, [conn1])
+        self.assertEqual(self.pool.size, 2)
+
+    def test_broken_connection_discarded(self):
+        def fail():
+            with self.pool.connection():
+                raise socket.error('reset')
+        self.assertRaises(socket.error, fail)
+        self.assertEqual(self.pool.size, 0)
+        self.assertIsNone(self.created[0].sock)
+
+    def test_dead_connection_replaced(self):
+        with self.pool.connection() as conn:
+            conn.close()
+        with self.pool.connection() as conn:
+            self.assertIsNotNone(conn.sock)
+        self.assertEqual(len(self.created), 2)
+        self.assertEqual(self.pool.size, 1)
+
+    def test_idle_reaped(self):
+        self.pool.idle_timeout = -1
+        with self.pool.connection():
+            pass
+        with self.pool.connection():
+            pass
+        self.assertEqual(len(self.created), 2)
+        self.assertIsNone(self.created[0].sock)
+
+    def test_clear(self):
+        idle = self.pool.checkout()
+        busy = self.pool.checkout()
+        self.pool.checkin(idle)
+        self.pool.clear()
+        self.assertIsNone(idle.sock)
+        self.assertIsNotNone(busy.sock)
+        self.pool.checkin(busy)
+        self.assertIsNone(busy.sock)
+        self.assertEqual(self.pool.size, 0)
+
+
+class RangeServer(object):
+    """ Serves ranged reads and writes of one file the way SMBFS does. """
+
+    def __init__(self, data=b''):
+        self.data = data
+        self.requests = []
+
+    def _retrieveFileFromOffset(self, path, file_obj, offset, max_length):
+        self.requests.append((offset, max_length))
+        file_obj.write(self.data[offset:offset + max_length])
+
+    def _storeFileFromOffset(self, path, file_obj, offset, truncate):
+        data = bytearray(b'' if truncate else self.data)
+        chunk = file_obj.read(100)
+        while chunk:
+            if len(data) < offset:
+                data.extend(b'\0' * (offset - len(data)))
+            data[offset:offset + len(chunk)] = chunk
+            offset += len(chunk)
+            chunk = file_obj.read(100)
+        self.data = bytes(data)
+        self.requests.append(offset)
+
+    def _overwrite(self, path, file_obj):
+        self._storeFileFromOffset(path, file_obj, 0, True)
+
+
+class TestSMBReadFile(unittest.TestCase):
+    """ Block fetching of files opened for reading. """
+    data = bytes(bytearray(range(256))) * 40
+
+    def setUp(self):
+        self.server = RangeServer(self.data)
+        self.file = SMBReadFile(self.server, '/f', len(self.data),
+                                block_size=1000, read_ahead=2)
+
+    def test_lazy(self):
+        self.assertEqual(self.server.requests, [])
+        self.assertEqual(self.file.read(10), self.data[:10])
+        self.assertEqual(self.server.requests, [(0, 1000)])
+
+    def test_read_all(self):
+        self.assertEqual(self.file.read(), self.data)
+        # The first block is fetched alone, the rest with read-ahead.
+        self.assertEqual(self.server.requests,
+                         [(0, 1000), (1000, 3000), (4000, 3000),
+                          (7000, 3000), (10000, 3000)])
+
+    def test_seek(self):
+        self.file.seek(-5, 2)
+        self.assertEqual(self.file.read(), self.data[-5:])
+        self.assertEqual(self.server.requests, [(10000, 1000)])
+        self.file.seek(1500)
+        self.assertEqual(self.file.tell(), 1500)
+        self.assertEqual(self.file.read(10), self.data[1500:1510])
+        self.file.seek(-10, 1)
+        self.assertEqual(self.file.read(10), self.data[1500:1510])
+        self.assertEqual(len(self.server.requests), 2)
+
+
+class TestSMBWriteFile(unittest.TestCase):
+    """ Streaming uploads of files opened for writing. """
+
+    def setUp(self):
+        self.server = RangeServer(b'old contents')
+        self.file = SMBWriteFile(self.server, '/f', chunk_size=10,
+                                 queue_size=2)
+
+    def test_truncated_on_open(self):
+        self.assertEqual(self.server.data, b'')
+
+    def test_write(self):
+        for n in range(100):
+            self.file.write(b'%02d' % n)
+        self.file.close()
+        self.assertEqual(self.server.data,
+                         b''.join(b'%02d' % n for n in range(100)))
+        # Uploads after the truncate carry at most `queue_size` chunks.
+        ends = self.server.requests
+        self.assertEqual(ends[0], 0)
+        self.assertTrue(all(0 < b - a <= 20 for a, b in zip(ends, ends[1:])))
+
+    def test_flush(self):
+        self.file.write(b'abc')
+        self.file.flush()
+        self.assertEqual(self.server.data, b'abc')
+        self.file.write(b'def')
+        self.file.close()
+        self.assertEqual(self.server.data, b'abcdef')
+
+    def test_seek(self):
+        self.file.write(b'abcdef')
+        self.file.seek(2)
+        self.file.write(b'X')
+        self.file.seek(10)
+        self.file.write(b'end')
+        self.file.close()
+        self.assertEqual(self.server.data, b'abXdef\0\0\0\0end')
+
+    def test_truncate(self):
+        self.file.write(b'abcdef')
+        self.file.truncate(3)
+        self.assertEqual(self.server.data, b'abc')
+        self.file.truncate(5)
+        self.assertEqual(self.server.data, b'abc\0\0')
+
+    def test_error_sticky(self):
+        store = self.server._storeFileFromOffset
+
+        def fail(path, file_obj, offset, truncate):
+            raise FSError('write failed')
+        self.server._storeFileFromOffset = fail
+        self.file.write(b'0123456789')
+        self.assertRaises(FSError, self.file.flush)
+        # Nothing more is sent, and every later call fails the same way.
+        self.server._storeFileFromOffset = store
+        self.assertRaises(FSError, self.file.write, b'abc')
+        self.assertRaises(FSError, self.file.flush)
+        self.assertRaises(FSError, self.file.close)
+        self.assertRaises(FSError, self.file.close)
+        self.assertEqual(self.server.data, b'')
+
+
+class TestLRUCacheBackend(unittest.TestCase):
+    """ Expiry, eviction and invalidation of the in-process cache. """
+
+    def setUp(self):
+        self.cache = LRUCacheBackend(max_entries=3)
+
+    def test_get_set(self):
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.set('a', 1, 60)
+        self.cache.set_many({'b': 2, 'c': 3}, 60)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(self.cache.get_many(['a', 'b', 'x']),
+                         {'a': 1, 'b': 2})
+
+    def test_expiry(self):
+        self.cache.set('a', 1, -1)
+        self.cache.set('b', 2, None)
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.get('b'), 2)
+
+    def test_eviction(self):
+        self.cache.set_many({'a': 1, 'b': 2}, 60)
+        self.cache.set('c', 3, 60)
+        # Touching 'a' makes 'b' the least recently used entry.
+        self.cache.get('a')
+        self.cache.set('d', 4, 60)
+        self.assertEqual(len(self.cache), 3)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('a'), 1)
+
+    def test_delete(self):
+        self.cache.set_many({'/a': 1, '/a/b': 2, '/ab': 3}, 60)
+        self.cache.delete_prefix('/a/')
+        self.assertIsNone(self.cache.get('/a/b'))
+        self.cache.delete('/ab')
+        self.cache.delete_many(['/a', '/x'])
+        self.assertEqual(len(self.cache), 0)
+
+    def test_pickle(self):
+        self.cache.set('a', 1, 60)
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            cache = pickle.loads(pickle.dumps(self.cache, protocol))
+            self.assertEqual(cache.max_entries, 3)
+            self.assertIsNone(cache.get('a'))
+
+
+class TestSMBInfo(unittest.TestCase):
+    """ Compact information read as a PyFilesystem info dict. """
+
+    def setUp(self):
+        self.info = SMBInfo(u'a.txt', 5, False, 0.0, 1.0, 2.0)
+
+    def test_mapping(self):
+        self.assertEqual(self.info['size'], 5)
+        self.assertEqual(self.info['st_mtime'], 2.0)
+        self.assertEqual(self.info['modified_time'],
+                         datetime.datetime.fromtimestamp(2.0))
+        self.assertEqual(self.info.get('missing', 1), 1)
+        self.assertEqual(len(dict(self.info)), len(self.info))
+        self.assertEqual(self.info, self.info.copy())
+
+    def test_copy(self):
+        info = self.info.copy()
+        del info['st_mode']
+        info.setdefault('st_nlink', 1)
+        info['size'] = 0
+        self.assertEqual(info.pop('st_nlink'), 1)
+        self.assertEqual(dict(info.items())['size'], 0)
+        self.assertFalse('st_mode' in info)
+        self.assertEqual(len(info), len(self.info) - 1)
+        # The original keeps its values.
+        self.assertEqual(self.info['size'], 5)
+        self.assertTrue('st_mode' in self.info)
+        self.assertEqual(pickle.loads(pickle.dumps(info)), info)
+
+    def test_pickle(self):
+        self.assertEqual(pickle.loads(pickle.dumps(self.info)), self.info)
+
+
+class ListingConnection(object):
+    """ Serves the listing of a single directory and counts listings. """
+
+    def __init__(self, names):
+        self.names = names
+        self.listings = 0
+
+    def listPath(self, share, path, *args, **kwargs):
+        self.listings += 1
+        return ([SharedFile(0, 0, 0, 0, 0, 0, ATTR_DIRECTORY, u'', name)
+                 for name in (u'.', u'..')] +
+                [SharedFile(0, 0, 0, 0, 1, 1, ATTR_ARCHIVE, u'', name)
+                 for name in self.names])
+
+    def deleteFiles(self, share, path, *args, **kwargs):
+        self.names.remove(path.rsplit('/', 1)[1])
+
+    def createDirectory(self, share, path, *args, **kwargs):
+        if path.rsplit('/', 1)[1] in self.names:
+            raise DestinationExistsError(path)
+
+
+class TestListingCache(unittest.TestCase):
+    """ Whole directory listings served from and patched in the cache. """
+
+    def setUp(self):
+        self.conn = ListingConnection([u'a.txt', u'b.log'])
+        self.fs = SMBFS('user', 'pass', 'server', 'ip', 'share',
+                        cache=LRUCacheBackend())
+        # Bypass the pool so every operation uses the listing connection.
+        self.fs._local.conn = self.conn
+
+    def test_listing_cached(self):
+        self.assertEqual(sorted(self.fs.listdir('/')), [u'a.txt', u'b.log'])
+        self.assertEqual(self.fs.listdir('/', wildcard='*.txt'), [u'a.txt'])
+        self.assertTrue(self.fs.isfile('/b.log'))
+        self.assertFalse(self.fs.exists('/c'))
+        self.assertEqual(self.conn.listings, 1)
+
+    def test_listing_patched(self):
+        self.fs.listdir('/')
+        self.fs.remove('/a.txt')
+        self.assertEqual(self.fs.listdir('/'), [u'b.log'])
+        self.assertFalse(self.fs.exists('/a.txt'))
+        self.assertEqual(self.conn.listings, 1)
+
+    def test_existing_directory(self):
+        self.fs.listdir('/')
+        self.assertRaises(DestinationExistsError, self.fs._create_dir,
+                          '/a.txt')
+        self.assertTrue(self.fs.exists('/a.txt'))
+        self.assertEqual(self.conn.listings, 1)
+
+    def test_changed_while_listing(self):
+        list_path = self.conn.listPath
+
+        def list_then_remove(*args, **kwargs):
+            results = list_path(*args, **kwargs)
+            if self.conn.listings == 1:
+                self.fs.remove('/a.txt')
+            return results
+        self.conn.listPath = list_then_remove
+        # The listing predating the removal is returned but not cached.
+        self.assertEqual(sorted(self.fs.listdir('/')), [u'a.txt', u'b.log'])
+        self.assertEqual(self.fs.listdir('/'), [u'b.log'])
+        self.assertFalse(self.fs.exists('/a.txt'))
+        self.assertEqual(self.conn.listings, 2)
+
+
+class FakeServerTestCase(unittest.TestCase):
+    """ Base for tests of SMBFS against the in-memory fake server. """
+
+    def setUp(self):
+        self.connection_class = smbfs.SMBConnection
+        smbfs.SMBConnection = FakeSMBConnection
+        self.server = FakeSMBServer('127.0.0.2')
+        self.fs = SMBFS('user', 'pass', 'server', '127.0.0.2', 'share')
+
+    def tearDown(self):
+        self.fs.close()
+        smbfs.SMBConnection = self.connection_class
+
+
+class TestWalk(FakeServerTestCase):
+    """ Directories listed in parallel and yielded in search order. """
+
+    def setUp(self):
+        super(TestWalk, self).setUp()
+        for d in ('a/b/c', 'a/d', 'e'):
+            self.fs.makedir(d, recursive=True)
+        for f in ('a/1.txt', 'a/b/c/2.txt', 'e/3.log'):
+            self.fs.setcontents(f, b'data')
+
+    def test_walkinfo(self):
+        walked = dict(self.fs.walkinfo(max_workers=3))
+        self.assertEqual(sorted(walked), ['/', '/a', '/a/b', '/a/b/c',
+                                          '/a/d', '/e'])
+        name, info = walked['/a/b/c'][0]
+        self.assertEqual((name, info['size']), ('2.txt', 4))
+
+    def test_order(self):
+        for search in ('breadth', 'depth'):
+            seen = [d for d, files in self.fs.walk(search=search)]
+            for d in seen[1:]:
+                before = seen.index(dirname(d)) < seen.index(d)
+                self.assertEqual(before, search == 'breadth')
+
+    def test_wildcards(self):
+        self.assertEqual(sorted(self.fs.walkfiles(wildcard='*.txt')),
+                         ['/a/1.txt', '/a/b/c/2.txt'])
+        self.assertEqual(list(self.fs.walkfiles(dir_wildcard='/e')),
+                         ['/e/3.log'])
+
+    def test_removedir_force(self):
+        self.server.populate('share', '/a/d', ['f{0}'.format(i)
+                                               for i in range(100)])
+        progress = []
+        calls = self.server.calls
+        self.fs.removedir('a', force=True,
+                          progress_callback=lambda *p: progress.append(p))
+        # One lookup, four listings, three wildcard deletes and four
+        # directory removals.
+        self.assertEqual(self.server.calls - calls, 12)
+        self.assertEqual(progress[-1], (102, 4))
+        self.assertEqual(self.fs.listdir('/'), ['e'])
+
+
+class TestServerWildcard(FakeServerTestCase):
+    """ Simple wildcards applied by the server, others on the client. """
+
+    def setUp(self):
+        super(TestServerWildcard, self).setUp()
+        for name in ('a.csv', 'b.csv', 'c.txt', 'D.CSV'):
+            self.fs.setcontents(name, b'')
+
+    def test_listdir(self):
+        self.assertEqual(sorted(self.fs.listdir(wildcard='*.csv')),
+                         ['a.csv', 'b.csv'])
+        self.assertEqual(self.fs.listdir(wildcard='[c]*'), ['c.txt'])
+        self.assertEqual(self.fs.listdir(wildcard='*.xml'), [])
+
+    def test_ilistdirinfo(self):
+        listing = self.fs.ilistdirinfo(wildcard='?.txt', full=True)
+        name, info = next(listing)
+        self.assertEqual((name, info['size']), ('c.txt', 0))
+        self.assertRaises(StopIteration, next, listing)
+
+
+class TestStat(FakeServerTestCase):
+    """ Single paths looked up without listing their directory. """
+
+    def setUp(self):
+        super(TestStat, self).setUp()
+        self.server.populate('share', '/', ['f{0}'.format(i)
+                                            for i in range(1000)], size=3)
+
+    def test_getinfo(self):
+        calls = self.server.calls
+        self.assertEqual(self.fs.getinfo('f10')['size'], 3)
+        self.assertTrue(self.fs.isdir('/'))
+        self.assertFalse(self.fs.exists('f1000'))
+        self.assertEqual(self.server.calls - calls, 3)
+
+    def test_not_found(self):
+        self.assertRaises(ResourceNotFoundError, self.fs.getinfo, 'f1/x')
+
+    def test_mutable(self):
+        # Callers such as fs.expose.fuse edit the dicts they are given.
+        info = self.fs.getinfo('f10')
+        del info['st_mode']
+        info.setdefault('st_nlink', 1)
+        info['size'] = 0
+        self.assertEqual(self.fs.getinfo('f10')['size'], 3)
+        name, info = self.fs.listdirinfo(wildcard='f10')[0]
+        info.update(size=0)
+        self.assertEqual(dict(self.fs.listdirinfo(wildcard='f10'))['f10'],
+                         self.fs.getinfo('f10'))
+
+    def test_refused(self):
+        for status in (0xc000000d, 0xc00000bb):
+            class RefusingConnection(FakeSMBConnection):
+                def getAttributes(self, service_name, path, timeout=30):
+                    raise _failure(status)
+            self.fs.close()
+            smbfs.SMBConnection = RefusingConnection
+            self.fs = SMBFS('user', 'pass', 'server', '127.0.0.2', 'share')
+            # The directory is listed instead.
+            self.assertEqual(self.fs.getinfo('f10')['size'], 3)
+
+
+class TestBatchLookup(FakeServerTestCase):
+    """ Many paths looked up a directory at a time. """
+
+    def setUp(self):
+        super(TestBatchLookup, self).setUp()
+        self.fs.makedir('d')
+        self.server.populate('share', '/d', ['a', 'b', 'c'], size=2)
+
+    def test_getinfo_many(self):
+        calls = self.server.calls
+        infos = self.fs.getinfo_many(['d/a', '/d/b', 'd/x', 'e/y', 'd'])
+        self.assertEqual(infos['d/a']['size'], 2)
+        self.assertEqual(infos['/d/b']['size'], 2)
+        self.assertTrue(isinstance(infos['d/x'], ResourceNotFoundError))
+        self.assertTrue(isinstance(infos['e/y'], ResourceNotFoundError))
+        self.assertTrue(stat.S_ISDIR(infos['d']['st_mode']))
+        # One listing of /d and one attribute query each for /e/y and /d.
+        self.assertEqual(self.server.calls - calls, 3)
+
+    def test_exists_many(self):
+        self.assertEqual(self.fs.exists_many(['d/a', 'd/x']),
+                         {'d/a': True, 'd/x': False})
+
+
+class TestAtomicSetcontents(FakeServerTestCase):
+    """ Files replaced by renaming a fully uploaded copy over them. """
+
+    def setUp(self):
+        super(TestAtomicSetcontents, self).setUp()
+        self.fs.close()
+        self.fs = SMBFS('user', 'pass', 'server', '127.0.0.2', 'share',
+                        atomic_setcontents=True)
+        self.fs.setcontents('a', b'old')
+
+    def test_replace(self):
+        self.fs.setcontents('a', b'new')
+        self.assertEqual(self.fs.getcontents('a', 'rb'), b'new')
+        self.assertEqual(self.fs.listdir(), ['a'])
+        self.assertFalse(self.fs.getmeta('atomic.setcontents'))
+
+    def test_directory(self):
+        self.fs.makedir('d')
+        self.fs.setcontents('d/f', b'data')
+        self.assertRaises(ResourceInvalidError, self.fs.setcontents, 'd',
+                          b'new')
+        self.assertEqual(self.fs.getcontents('d/f', 'rb'), b'data')
+        self.assertEqual(sorted(self.fs.listdir()), ['a', 'd'])
+
+    def test_original_error(self):
+        try:
+            self.fs.setcontents('missing/f', b'data')
+        except ResourceNotFoundError as e:
+            self.assertEqual(e.path, '/missing/f')
+        else:
+            self.fail('ResourceNotFoundError not raised')
+
+    def test_unicode(self):
+        name = u'\u00e9t\u00e9.txt'
+        self.fs.setcontents(name, b'old')
+        self.fs.setcontents(name, b'new')
+        self.assertEqual(self.fs.getcontents(name, 'rb'), b'new')
+        self.assertEqual(sorted(self.fs.listdir()), [u'a', name])
+
+    def test_failed_swap(self):
+        rename = self.fs._rename
+
+        def fail_into_place(src, dst):
+            if src.endswith('.tmp') and not self.fs.exists(dst):
+                raise ResourceNotFoundError(dst)
+            rename(src, dst)
+        self.fs._rename = fail_into_place
+        self.assertRaises(ResourceNotFoundError, self.fs.setcontents, 'a',
+                          b'new')
+        # The old file is back and nothing is left behind.
+        self.assertEqual(self.fs.getcontents('a', 'rb'), b'old')
+        self.assertEqual(self.fs.listdir(), ['a'])
+
+
+class TestCopyMove(FakeServerTestCase):
+    """ Copies streamed between connections and moves made with renames. """
+
+    def setUp(self):
+        super(TestCopyMove, self).setUp()
+        self.fs.makedir('src/sub', recursive=True)
+        self.data = b'0123456789' * 10000
+        self.fs.setcontents('src/a', self.data)
+        self.fs.setcontents('src/sub/b', b'b')
+
+    def test_copy(self):
+        self.fs.copy('src/a', 'a', chunk_size=1000)
+        self.assertEqual(self.fs.getcontents('a'), self.data)
+        self.assertRaises(DestinationExistsError, self.fs.copy, 'src/sub/b',
+                          'a')
+        self.fs.copy('src/sub/b', 'a', overwrite=True)
+        self.assertEqual(self.fs.getcontents('a'), b'b')
+
+    def test_copy_onto_itself(self):
+        self.assertRaises(DestinationExistsError, self.fs.copy, 'src/a',
+                          'src/a')
+        self.fs.copy('src/a', '/src/./a', overwrite=True)
+        self.assertEqual(self.fs.getcontents('src/a'), self.data)
+        # Spooled in case the share ignores case.
+        self.fs.copy('src/a', 'src/A', overwrite=True)
+        self.assertEqual(self.fs.getcontents('src/a'), self.data)
+
+    def test_copydir(self):
+        self.fs.copydir('src', 'dst')
+        self.assertEqual(self.fs.getcontents('dst/a'), self.data)
+        self.assertEqual(self.fs.getcontents('dst/sub/b'), b'b')
+
+    def test_move(self):
+        self.fs.setcontents('a', b'old')
+        self.assertRaises(DestinationExistsError, self.fs.move, 'src/a', 'a')
+        self.fs.move('src/a', 'a', overwrite=True)
+        self.assertEqual(self.fs.getcontents('a'), self.data)
+        self.assertFalse(self.fs.exists('src/a'))
+
+    def test_movedir(self):
+        calls = self.server.calls
+        self.fs.movedir('src', 'dst')
+        # One lookup of the source and one rename.
+        self.assertEqual(self.server.calls - calls, 2)
+        self.fs.makedir('src')
+        self.fs.movedir('dst', 'src', overwrite=True)
+        self.assertEqual(sorted(self.fs.walkfiles()), ['/src/a', '/src/sub/b'])
+
+
+class TestOpenWriters(FakeServerTestCase):
+    """ Files open for writing do not hold connections while idle. """
+
+    def test_more_writers_than_connections(self):
+        files = [self.fs.open('f{0}'.format(i), 'wb') for i in range(6)]
+        for f in files:
+            f.write(b'x' * 100000)
+        self.assertEqual(self.fs.listdir(), ['f{0}'.format(i)
+                                             for i in range(6)])
+        for f in files:
+            f.close()
+        self.assertEqual(self.fs.getsize('f5'), 100000)
+
+    def test_one_connection(self):
+        self.fs.close()
+        self.fs = SMBFS('user', 'pass', 'server', '127.0.0.2', 'share',
+                        max_connections=1)
+        with self.fs.open('a', 'wb') as f:
+            f.write(b'x' * 100000)
+            self.fs.setcontents('b', b'b')
+            f.write(b'y')
+        self.fs.copy('a', 'c')
+        self.assertEqual(self.fs.getcontents('c', 'rb'), b'x' * 100000 + b'y')
+
+
+class TestInPlace(FakeServerTestCase):
+    """ Files appended to and updated without copying them whole. """
+
+    def setUp(self):
+        super(TestInPlace, self).setUp()
+        self.fs.setcontents('log', b'x' * 100000)
+        self.fetched = []
+        retrieve = self.fs._retrieveFileFromOffset
+
+        def record(path, file_obj, offset, max_length):
+            self.fetched.append((offset, max_length))
+            return retrieve(path, file_obj, offset, max_length)
+        self.fs._retrieveFileFromOffset = record
+
+    def test_append(self):
+        with self.fs.open('log', 'ab') as f:
+            f.write(b'line\n')
+        self.assertEqual(self.fetched, [])
+        self.assertEqual(self.fs.getcontents('log'), b'x' * 100000 + b'line\n')
+
+        with self.fs.open('new', 'a+b') as f:
+            f.write(b'abc')
+            f.seek(0)
+            self.assertEqual(f.read(), b'abc')
+
+    def test_update(self):
+        with self.fs.open('log', 'r+b') as f:
+            f.seek(99990)
+            f.write(b'abc')
+            self.assertEqual(f.read(2), b'xx')
+            f.seek(-1, 2)
+            f.write(b'yz')
+        self.assertEqual(self.fetched, [(99993, 64 * 1024)])
+        self.assertEqual(self.fs.getcontents('log'),
+                         b'x' * 99990 + b'abcxxxxxx' + b'yz')
+
+    def test_changed_by_another_client(self):
+        self.fs._cache = LRUCacheBackend()
+        self.fs.setcontents('a', b'aaa')
+        self.assertEqual(self.fs.getsize('a'), 3)
+        self.server.lookup('share', 'a').data.extend(b'BBBB')
+        with self.fs.open('a', 'ab') as f:
+            f.write(b'cc')
+        self.assertEqual(self.fs.getcontents('a', 'rb'), b'aaaBBBBcc')
+
+
+class TestWriteBehind(FakeServerTestCase):
+    """ Writes acknowledged once spooled and uploaded in the background. """
+
+    def setUp(self):
+        super(TestWriteBehind, self).setUp()
+        self.fs.close()
+        self.fs = SMBFS('user', 'pass', 'server', '127.0.0.2', 'share',
+                        write_behind=True)
+
+    def test_pending(self):
+        # Uploads cannot reach the server while its lock is held.
+        with self.server.lock:
+            for i in range(10):
+                self.fs.setcontents('f{0}'.format(i), b'old')
+            with self.fs.open('f0', 'wb') as f:
+                f.write(b'new')
+            self.fs.setcontents('f0', b'newest')
+        self.assertEqual(self.fs.getcontents('f0'), b'newest')
+        self.assertEqual(len(self.fs.listdir('/')), 10)
+        self.fs.flush()
+
+    def test_wildcard_listing(self):
+        # Uploads wait for a moment, other connections being free.
+        started = threading.Event()
+        overwrite = self.fs._overwrite
+
+        def slow(path, file_obj):
+            started.set()
+            time.sleep(0.2)
+            overwrite(path, file_obj)
+        self.fs._overwrite = slow
+        self.fs.setcontents('f0', b'data')
+        self.fs.setcontents('f1', b'data')
+        started.wait()
+        self.assertEqual(self.fs.listdir('/', wildcard='f*'), ['f0', 'f1'])
+
+    def test_removedir_parent_pending(self):
+        self.fs.makedir('foo/bar', recursive=True)
+        overwrite = self.fs._overwrite
+
+        def slow(path, file_obj):
+            time.sleep(0.2)
+            overwrite(path, file_obj)
+        self.fs._overwrite = slow
+        self.fs.setcontents('foo/file.txt', b'data')
+        # The parent is only removed once its upload is done, so not at all.
+        self.assertRaises(DirectoryNotEmptyError, self.fs.removedir,
+                          'foo/bar', recursive=True)
+        self.assertFalse(self.fs.exists('foo/bar'))
+        self.fs.flush()
+        self.assertEqual(self.fs.getcontents('foo/file.txt', 'rb'), b'data')
+
+    def test_text(self):
+        for write_behind in (False, True):
+            self.fs.close()
+            self.fs = SMBFS('user', 'pass', 'server', '127.0.0.2', 'share',
+                            write_behind=write_behind)
+            self.fs.setcontents('t', u'\u00e9t\u00e9', encoding='latin-1')
+            self.fs.flush()
+            self.assertEqual(self.fs.getcontents('t', 'rb'), b'\xe9t\xe9')
+
+    def test_error(self):
+        self.fs.setcontents('missing/f', b'data')
+        self.assertRaises(FSError, self.fs.flush)
+        self.fs.flush()
+
+
+class TestWatch(FakeServerTestCase):
+    """ Changes found by polling directory snapshots. """
+
+    def setUp(self):
+        super(TestWatch, self).setUp()
+        self.fs.makedir('a/b', recursive=True)
+        self.fs.setcontents('a/1', b'data')
+
+    def changes(self, events, count):
+        return sorted((type(e).__name__, e.path)
+                      for e in itertools.islice(events, count))
+
+    def test_watch(self):
+        events = self.fs.watch('/', interval=0, max_workers=1)
+        self.fs.setcontents('a/2', b'')
+        self.fs.setcontents('a/1', b'changed')
+        self.fs.removedir('a/b')
+        self.fs.makedir('c')
+        self.fs.setcontents('c/3', b'')
+        self.assertEqual(self.changes(events, 5), [
+            ('CREATED', '/a/2'), ('CREATED', '/c'), ('CREATED', '/c/3'),
+            ('MODIFIED', '/a/1'), ('REMOVED', '/a/b')])
+
+        # Unchanged directories are looked up, not listed.
+        self.fs.setcontents('c/4', b'')
+        calls = self.server.calls
+        self.assertEqual(self.changes(events, 1), [('CREATED', '/c/4')])
+        self.assertEqual(self.server.calls - calls, 4)
+
+    def test_not_recursive(self):
+        events = self.fs.watch('/', interval=0, recursive=False)
+        self.fs.setcontents('a/2', b'')
+        self.fs.removedir('a', force=True)
+        self.assertEqual(self.changes(events, 1), [('REMOVED', '/a')])
+
+
+class TestMetrics(FakeServerTestCase):
+    """ Measurements reported to a metrics backend. """
+
+    def setUp(self):
+        super(TestMetrics, self).setUp()
+        self.fs.close()
+        self.metrics = MetricsCollector()
+        self.fs = SMBFS('user', 'pass', 'server', '127.0.0.2', 'share',
+                        cache=LRUCacheBackend(), metrics=self.metrics)
+
+    def test_requests(self):
+        self.fs.setcontents('a', b'0123456789')
+        self.assertEqual(self.fs.getcontents('a', 'rb'), b'0123456789')
+        snapshot = self.metrics.snapshot()
+        requests = snapshot['requests']
+        self.assertEqual(requests['connect']['count'], 1)
+        self.assertEqual(requests['storeFileFromOffset']['bytes'], 10)
+        self.assertEqual(requests['retrieveFileFromOffset']['bytes'], 10)
+        for stats in requests.values():
+            self.assertEqual(sum(stats['histogram']), stats['count'])
+        self.assertEqual(snapshot['waits']['checkout']['count'],
+                         sum(s['count'] for s in requests.values()) - 1)
+
+        # A failed lookup costs one round trip, cached afterwards.
+        self.metrics.reset()
+        self.assertFalse(self.fs.isfile('missing'))
+        self.assertFalse(self.fs.isfile('missing'))
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(list(snapshot['requests']), ['getAttributes'])
+        stats = snapshot['requests']['getAttributes']
+        self.assertEqual((stats['count'], stats['errors']), (1, 1))
+        self.assertEqual(snapshot['cache']['info'], {'hits': 1, 'misses': 1})
+
+    def test_cache_and_lock(self):
+        self.fs.setcontents('a', b'')
+        self.fs.listdir('/')
+        self.fs.listdir('/')
+        self.fs.getinfo('a')
+        self.fs.conn
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(snapshot['cache']['listing'],
+                         {'hits': 1, 'misses': 1})
+        self.assertEqual(snapshot['cache']['info'], {'hits': 1, 'misses': 0})
+        self.assertEqual(snapshot['waits']['synchronize']['count'], 1)
+
+        # Pickled copies keep a working lock and start counting anew.
+        fs = pickle.loads(pickle.dumps(self.fs))
+        self.assertTrue(fs.isfile('a'))
+        fs.conn
+        snapshot = fs.metrics.snapshot()
+        self.assertEqual(snapshot['requests']['connect']['count'], 2)
+        self.assertEqual(snapshot['waits']['synchronize']['count'], 1)
+        fs.close()
+
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            metrics = pickle.loads(pickle.dumps(self.metrics, protocol))
+            metrics.cache('info', True)
+            self.assertEqual(metrics.snapshot()['cache'],
+                             {'info': {'hits': 1, 'misses': 0}})
+
+
+class TestTreeTransfer(FakeServerTestCase):
+    """ Trees mirrored between local disk and the share. """
+
+    def setUp(self):
+        super(TestTreeTransfer, self).setUp()
+        self.local = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.local, 'src', 'sub'))
+        for i in range(40):
+            with open(os.path.join(self.local, 'src', str(i)), 'wb') as f:
+                f.write(b'x' * i)
+        with open(os.path.join(self.local, 'src', 'sub', 'big'), 'wb') as f:
+            f.write(b'y' * (2 * 1024 * 1024))
+
+    def tearDown(self):
+        shutil.rmtree(self.local)
+        super(TestTreeTransfer, self).tearDown()
+
+    def test_round_trip(self):
+        progress = []
+        self.fs.upload_tree(os.path.join(self.local, 'src'), 'dst',
+                            progress_callback=lambda *p: progress.append(p))
+        self.assertEqual(self.fs.getcontents('dst/7'), b'x' * 7)
+        self.assertEqual(self.fs.getsize('dst/sub/big'), 2 * 1024 * 1024)
+        self.assertEqual(progress[-1][:3], (41, 41, progress[-1][3]))
+
+        copy = os.path.join(self.local, 'copy')
+        self.fs.download_tree('dst', copy, max_bytes_per_second=1e9)
+        with open(os.path.join(copy, '39'), 'rb') as f:
+            self.assertEqual(f.read(), b'x' * 39)
+        self.assertEqual(os.path.getsize(os.path.join(copy, 'sub', 'big')),
+                         2 * 1024 * 1024)
+
+    def test_download(self):
+        data = bytes(bytearray(i % 251 for i in range(100000)))
+        self.fs.setcontents('file', data)
+        self.fs.setcontents('empty', b'')
+        local_path = os.path.join(self.local, 'file')
+        self.fs.download('file', local_path, part_size=4096, max_workers=4)
+        with open(local_path, 'rb') as f:
+            self.assertEqual(f.read(), data)
+        self.fs.download('empty', local_path)
+        self.assertEqual(os.path.getsize(local_path), 0)
+
+    def test_download_changed_by_another_client(self):
+        self.fs._cache = LRUCacheBackend()
+        self.fs.setcontents('a', b'aaaa')
+        self.assertEqual(self.fs.getsize('a'), 4)
+        self.server.lookup('share', 'a').data.extend(b'BBBBBB')
+        local_path = os.path.join(self.local, 'a')
+        self.fs.download('a', local_path, part_size=3)
+        with open(local_path, 'rb') as f:
+            self.assertEqual(f.read(), b'aaaaBBBBBB')
+
+    def test_sync_tree(self):
+        self.fs.upload_tree(os.path.join(self.local, 'src'), 'dst')
+        copy = os.path.join(self.local, 'copy')
+        manifest = os.path.join(self.local, 'manifest')
+        self.assertEqual(self.fs.sync_tree('dst', copy, manifest),
+                         {'downloaded': 41, 'removed': 0, 'unchanged': 0})
+
+        self.fs.setcontents('dst/3', b'zzzz')
+        self.fs.removedir('dst/sub', force=True)
+        self.assertEqual(self.fs.sync_tree('dst', copy, manifest),
+                         {'downloaded': 1, 'removed': 1, 'unchanged': 39})
+        with open(os.path.join(copy, '3'), 'rb') as f:
+            self.assertEqual(f.read(), b'zzzz')
+        self.assertFalse(os.path.exists(os.path.join(copy, 'sub')))
+
+        # Without a manifest the local files themselves are compared.
+        with open(os.path.join(copy, 'extra'), 'wb') as f:
+            f.write(b'extra')
+        self.assertEqual(self.fs.sync_tree('dst', copy),
+                         {'downloaded': 0, 'removed': 1, 'unchanged': 40})
+
+
+class TestContentCache(FakeServerTestCase):
+    """ Files opened for reading served from local copies. """
+
+    def setUp(self):
+        super(TestContentCache, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.fs.content_cache = ContentCache(self.directory, max_bytes=10)
+        self.fs.setcontents('a', b'aaaaaa')
+        self.fs.setcontents('b', b'bbbbbb')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(TestContentCache, self).tearDown()
+
+    def test_hit(self):
+        self.assertEqual(self.fs.getcontents('a'), b'aaaaaa')
+        calls = self.server.calls
+        self.assertEqual(self.fs.getcontents('a'), b'aaaaaa')
+        # Only the file was looked up.
+        self.assertEqual(self.server.calls, calls + 1)
+        self.assertEqual(len(ContentCache(self.directory)), 1)
+
+        self.fs.setcontents('a', b'changed')
+        self.assertEqual(len(self.fs.content_cache), 0)
+        self.assertEqual(self.fs.getcontents('a'), b'changed')
+
+    def test_eviction(self):
+        self.fs.getcontents('a')
+        self.fs.getcontents('b')
+        cache = self.fs.content_cache
+        self.assertEqual(len(cache), 1)
+        self.assertIsNone(cache.get(self.fs._cache_key('/a'), 6,
+                                    self.fs.getinfo('a')['st_mtime']))
+        with self.fs.open('b', 'r') as f:
+            self.assertEqual(f.read(), 'bbbbbb')
+
+    def test_tree_changes(self):
+        cache = self.fs.content_cache = ContentCache(self.directory,
+                                                     max_bytes=100)
+        self.fs.makedir('d/sub', recursive=True)
+        for name in ('d/x', 'd/y', 'd/sub/z'):
+            self.fs.setcontents(name, b'data')
+            self.fs.getcontents(name)
+        self.assertEqual(len(cache), 3)
+        self.fs.rename('d', 'e')
+        self.assertEqual(len(cache), 0)
+
+        for name in ('e/x', 'e/y', 'e/sub/z'):
+            self.fs.getcontents(name)
+        self.assertEqual(len(cache), 3)
+        self.fs.removedir('e', force=True)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_shared_directory(self):
+        stale = os.path.join(self.directory, '.tmpold')
+        open(stale, 'wb').close()
+        os.utime(stale, (0, 0))
+        cache = self.fs.content_cache
+
+        def fill(f):
+            # Another process starts using the directory mid-download.
+            ContentCache(self.directory)
+            f.write(b'aaaaaa')
+        path = cache.put('key', 6, 0, fill)
+        self.assertFalse(os.path.exists(stale))
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'aaaaaa')
+
+        def cleared(f):
+            f.write(b'aaaaaa')
+            shutil.rmtree(self.directory)
+        self.assertIsNone(cache.put('other', 6, 0, cleared))
+
+        os.makedirs(self.directory)
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            copy = pickle.loads(pickle.dumps(cache, protocol))
+            self.assertEqual(copy.directory, self.directory)
+            self.assertEqual(copy.max_bytes, 10)
+
+
+class TestSessionRegistry(FakeServerTestCase):
+    """ Pools leased from the process-wide registry. """
+
+    def shared(self, password='pass'):
+        return SMBFS('user', password, 'server', '127.0.0.2', 'share',
+                     shared_sessions=True)
+
+    def tearDown(self):
+        smbfs.session_registry.clear()
+        super(TestSessionRegistry, self).tearDown()
+
+    def test_lease(self):
+        fs = self.shared()
+        fs.listdir('/')
+        fs.close()
+        other = self.shared()
+        self.assertIs(other._pool, fs._pool)
+        other.listdir('/')
+        self.assertEqual(other._pool.size, 1)
+        copy = pickle.loads(pickle.dumps(other))
+        self.assertIs(copy._pool, fs._pool)
+        self.assertIsNot(self.shared('other')._pool, fs._pool)
+        other.close()
+        copy.close()
+        self.assertEqual(fs._pool.size, 1)
+
+    def test_idle_timeout(self):
+        registry = SMBSessionRegistry(idle_timeout=0)
+        pool = registry.acquire('key', self.fs._new_pool)
+        registry.acquire('key', None)
+        registry.release('key')
+        self.assertEqual(len(registry), 1)
+        registry.release('key')
+        self.assertEqual(len(registry), 0)
+        self.assertIsNot(registry.acquire('key', self.fs._new_pool), pool)
+
+    def test_expired_without_further_use(self):
+        registry = SMBSessionRegistry(idle_timeout=0.05)
+        pool = registry.acquire('key', self.fs._new_pool)
+        with pool.connection():
+            pass
+        registry.release('key')
+        time.sleep(0.5)
+        self.assertEqual(len(registry), 0)
+        self.assertEqual(pool.size, 0)
+
+    def test_instance_not_kept(self):
+        fs = self.shared()
+        fs.listdir('/')
+        fs.close()
+        ref = weakref.ref(fs)
+        del fs
+        gc.collect()
+        self.assertIsNone(ref())
+
+
+@unittest.skipIf(AsyncSMBFS is None, 'asyncio front end needs Python 3.6')
+class TestAsync(FakeServerTestCase):
+    """ Calls made through AsyncSMBFS from coroutines. """
+
+    def setUp(self):
+        super(TestAsync, self).setUp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.afs = AsyncSMBFS(self.fs)
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.afs.close())
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        super(TestAsync, self).tearDown()
+
+    def run_async(self, awaitable):
+        return self.loop.run_until_complete(awaitable)
+
+    def collect(self, iterator):
+        items = []
+        while True:
+            try:
+                items.append(self.run_async(iterator.__anext__()))
+            except StopAsyncIteration:
+                return items
+
+    def test_calls(self):
+        self.run_async(self.afs.makedir('a/b', recursive=True))
+        self.run_async(asyncio.gather(*[
+            self.afs.setcontents('a/{0}'.format(i), b'x' * i)
+            for i in range(20)]))
+        self.assertEqual(self.run_async(self.afs.getinfo('a/7'))['size'], 7)
+        self.run_async(self.afs.rename('a/7', 'a/b/7'))
+        self.assertEqual(sorted(self.collect(self.afs.ilistdir('a/b'))),
+                         ['7'])
+        self.assertEqual([p for p, files in self.collect(
+            self.afs.walkinfo('/'))], ['/', '/a', '/a/b'])
+        with self.assertRaises(ResourceNotFoundError):
+            self.run_async(self.afs.remove('a/7'))
+
+    def test_open(self):
+        f = self.run_async(self.afs.open('f', 'wb'))
+        self.run_async(f.write(b'data' * 1000))
+        self.run_async(f.close())
+        f = self.run_async(self.afs.open('f', 'rb'))
+        self.assertEqual(self.run_async(f.read()), b'data' * 1000)
+        self.run_async(f.close())
@@ -0,0 +1,275 @@
+""" Benchmarks of smbfs against the in-memory fake server.
+
+    Run with `make bench` or `python -m smbfs.tests.benchmarks [name ...]`
+    to run only some of them, adding `--json` for the results as JSON.  Each
+    result has the wall time, the number of round trips to the server and
+    the peak resident set size of the process so far.  Sizes are set through
+    the environment, for instance SMBFS_BENCH_LARGE_SIZE for the size of the
+    large files, and SMBFS_BENCH_LATENCY (seconds per request) and
+    SMBFS_BENCH_BANDWIDTH (bytes per second) make the server behave like a
+    remote one.
+"""
+import datetime
+import gc
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from contextlib import contextmanager
+
+import smbfs
+from smbfs import LRUCacheBackend
+from smbfs import SMBFS
+from smbfs.tests.fakesmb import FakeSMBConnection
+from smbfs.tests.fakesmb import FakeSMBServer
+
+# Results of the benchmarks run, as dicts.
+RESULTS = []
+
+# Print results as they come rather than as JSON at the end.
+_verbose = True
+
+
+def _setting(name, default, kind=int):
+    return kind(os.environ.get('SMBFS_BENCH_' + name, default))
+
+
+def _server():
+    """ Fake server for a benchmark, slowed down as configured. """
+    smbfs.SMBConnection = FakeSMBConnection
+    server = FakeSMBServer('benchmark', _setting('LATENCY', 0, float),
+                           _setting('BANDWIDTH', 0, float))
+    server.lookup('share', '/')
+    return server
+
+
+def _peak_rss():
+    """ Peak resident set size of the process in MiB. """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak / (1024.0 * 1024 if sys.platform == 'darwin' else 1024.0)
+
+
+@contextmanager
+def _measure(name, server, entries=None, size=None):
+    """ Record the time and round trips taken by the block.
+
+        The cost is reported per entry given `entries` and as a rate given
+        the `size` in bytes.
+    """
+    calls = server.calls
+    start = time.time()
+    yield
+    result = {'name': name, 'seconds': time.time() - start,
+              'round_trips': server.calls - calls,
+              'peak_rss_mib': _peak_rss()}
+    cost = ''
+    if size is not None:
+        result['bytes'] = size
+        cost = '{0:.1f} MiB/s'.format(
+            size / max(result['seconds'], 1e-9) / 1024 / 1024)
+    elif entries is not None:
+        result['entries'] = entries
+        cost = '{0:.2f} us/entry'.format(result['seconds'] * 1e6 / entries)
+    RESULTS.append(result)
+    if _verbose:
+        print('{0:<40} {1:>16} {2:>10} trips {3:>8.1f} MiB peak RSS'.format(
+            name, cost, result['round_trips'], result['peak_rss_mib']))
+
+
+def _eager_info(smb_info):
+    """ Info dict built the way listdirinfo used to build it. """
+    return {'size': smb_info.file_size,
+            'created_time': datetime.datetime.fromtimestamp(
+                smb_info.create_time),
+            'st_ctime': smb_info.create_time,
+            'accessed_time': datetime.datetime.fromtimestamp(
+                smb_info.last_access_time),
+            'st_atime': smb_info.last_access_time,
+            'modified_time': datetime.datetime.fromtimestamp(
+                smb_info.last_write_time),
+            'st_mtime': smb_info.last_write_time}
+
+
+def bench_listing(entries):
+    """ Cost per entry of listing one large directory. """
+    server = _server()
+    fs = SMBFS('user', 'pass', 'server', 'benchmark', 'share',
+               cache=LRUCacheBackend())
+    with _measure('fake server with {0} files'.format(entries), server):
+        server.populate('share', '/', ('file{0:07d}.dat'.format(i)
+                                       for i in range(entries)))
+    gc.collect()
+
+    with _measure('listdirinfo, uncached', server, entries):
+        listing = fs.listdirinfo('/')
+
+    with _measure('listdirinfo, cached', server, entries):
+        fs.listdirinfo('/')
+
+    with _measure('modified_time of every entry', server, entries):
+        for name, info in listing:
+            info['modified_time']
+
+    del listing
+    fs.close()
+    gc.collect()
+
+    # The previous representation, measured last as peak RSS only grows.
+    with _measure('SharedFile cache and eager dicts', server, entries):
+        with fs._connection() as conn:
+            results = conn.listPath('share', '/')
+        cached = dict((i.filename, i) for i in results)
+        listing = [(i.filename, _eager_info(i)) for i in results]
+    return cached, listing
+
+
+def bench_open(entries, opens=1000):
+    """ Cost of opening one file as its directory grows. """
+    server = _server()
+    fs = SMBFS('user', 'pass', 'server', 'benchmark', 'share')
+    created = 0
+    for size in (entries // 100, entries // 10, entries):
+        server.populate('share', '/', ('file{0:07d}.dat'.format(i)
+                                       for i in range(created, size)))
+        created = size
+        with _measure('open() among {0} files'.format(size), server, opens):
+            for i in range(opens):
+                fs.open('/file0000000.dat', 'rb').close()
+    fs.close()
+
+
+def bench_getinfo(misses=1000):
+    """ Cost of looking up paths that do not exist. """
+    server = _server()
+    fs = SMBFS('user', 'pass', 'server', 'benchmark', 'share',
+               cache=LRUCacheBackend())
+    fs.makedir('dir')
+    for name in ('getinfo misses', 'getinfo misses, negative cache warm'):
+        with _measure(name, server, misses):
+            for i in range(misses):
+                fs.exists('dir/missing{0}'.format(i % 100))
+    fs.close()
+
+
+def bench_files(small_files, large_size):
+    """ Throughput of open() reading and writing small and large files. """
+    server = _server()
+    fs = SMBFS('user', 'pass', 'server', 'benchmark', 'share')
+    small = b'x' * 4096
+    with _measure('write {0} x {1} B'.format(small_files, len(small)),
+                  server, size=small_files * len(small)):
+        for i in range(small_files):
+            with fs.open('small{0}'.format(i), 'wb') as f:
+                f.write(small)
+    with _measure('read {0} x {1} B'.format(small_files, len(small)),
+                  server, size=small_files * len(small)):
+        for i in range(small_files):
+            with fs.open('small{0}'.format(i), 'rb') as f:
+                f.read()
+
+    block = b'x' * 1024 * 1024
+    with _measure('write 1 x {0} B'.format(large_size), server,
+                  size=large_size):
+        with fs.open('large', 'wb') as f:
+            for offset in range(0, large_size, len(block)):
+                f.write(block[:large_size - offset])
+    with _measure('read 1 x {0} B'.format(large_size), server,
+                  size=large_size):
+        with fs.open('large', 'rb') as f:
+            while f.read(len(block)):
+                pass
+    fs.close()
+
+
+def bench_tree(dirs, files):
+    """ Cost of making, walking and removing a tree of directories. """
+    server = _server()
+    fs = SMBFS('user', 'pass', 'server', 'benchmark', 'share')
+    depth = 10
+    with _measure('makedir recursive, depth {0}'.format(depth), server,
+                  depth):
+        fs.makedir('/'.join('d{0}'.format(i) for i in range(depth)),
+                   recursive=True)
+
+    for i in range(dirs):
+        path = 'tree/{0}/{1}'.format(i % 10, i)
+        fs.makedir(path, recursive=True, allow_recreate=True)
+        server.populate('share', path, ('f{0}'.format(j)
+                                        for j in range(files)))
+    entries = dirs * (files + 1)
+    with _measure('walk {0} dirs'.format(dirs), server, entries):
+        for path, names in fs.walk('tree'):
+            pass
+    with _measure('removedir force, {0} dirs'.format(dirs), server, entries):
+        fs.removedir('tree', force=True)
+    fs.close()
+
+
+def bench_transfer(small_files, large_files, large_size):
+    """ Throughput of upload_tree(), download_tree() and download(). """
+    server = _server()
+    fs = SMBFS('user', 'pass', 'server', 'benchmark', 'share')
+    local = tempfile.mkdtemp()
+    try:
+        for name, count, size in (('small', small_files, 4096),
+                                  ('large', large_files, large_size)):
+            src = os.path.join(local, name)
+            os.makedirs(src)
+            block = b'x' * min(size, 1024 * 1024)
+            for i in range(count):
+                with open(os.path.join(src, str(i)), 'wb') as f:
+                    for offset in range(0, size, len(block)):
+                        f.write(block[:size - offset])
+
+            with _measure('upload_tree, {0} x {1} B'.format(count, size),
+                          server, size=count * size):
+                fs.upload_tree(src, name)
+
+            with _measure('download_tree, {0} x {1} B'.format(count, size),
+                          server, size=count * size):
+                fs.download_tree(name, os.path.join(local, name + '.copy'))
+
+            if count:
+                with _measure('download, 1 x {0} B'.format(size), server,
+                              size=size):
+                    fs.download(name + '/0',
+                                os.path.join(local, name + '.0'))
+                os.remove(os.path.join(local, name + '.0'))
+            shutil.rmtree(src)
+            shutil.rmtree(os.path.join(local, name + '.copy'))
+            fs.removedir(name, force=True)
+    finally:
+        shutil.rmtree(local)
+        fs.close()
+
+
+BENCHMARKS = {
+    'listing': lambda: bench_listing(_setting('ENTRIES', 500000)),
+    'open': lambda: bench_open(_setting('ENTRIES', 500000)),
+    'getinfo': lambda: bench_getinfo(),
+    'files': lambda: bench_files(_setting('SMALL_FILES', 10000),
+                                 _setting('LARGE_SIZE', 256 * 1024 * 1024)),
+    'tree': lambda: bench_tree(_setting('DIRS', 1000),
+                               _setting('FILES_PER_DIR', 10)),
+    'transfer': lambda: bench_transfer(
+        _setting('SMALL_FILES', 10000), _setting('LARGE_FILES', 3),
+        _setting('LARGE_SIZE', 256 * 1024 * 1024)),
+}
+
+
+if __name__ == '__main__':
+    names = [arg for arg in sys.argv[1:] if arg != '--json']
+    _verbose = '--json' not in sys.argv[1:]
+    for name in names or sorted(BENCHMARKS):
+        BENCHMARKS[name]()
+    if not _verbose:
+        settings = dict((key, value) for key, value in os.environ.items()
+                        if key.startswith('SMBFS_BENCH_'))
+        json.dump({'settings': settings, 'results': RESULTS}, sys.stdout,
+                  indent=2, sort_keys=True)
+        print('')
@@ -0,0 +1,275 @@
+""" In-memory stand-in for a pysmb SMBConnection.
+
+    `FakeSMBServer` holds shares in memory and `FakeSMBConnection` implements
+    the part of the pysmb API SMBFS uses against it, raising the same
+    OperationFailure statuses a server would.  Patch it in with:
+
+        smbfs.SMBConnection = FakeSMBConnection
+        server = FakeSMBServer('10.0.0.1')
+        fs = SMBFS('user', 'pass', 'server', '10.0.0.1', 'share')
+
+    `latency` and `bandwidth` slow requests down like a remote server, and
+    `calls` counts the requests made.
+"""
+import fnmatch
+import threading
+import time
+
+from smb.base import NotConnectedError
+from smb.base import OperationFailure
+from smb.base import SharedFile
+from smb.smb_constants import ATTR_ARCHIVE
+from smb.smb_constants import ATTR_DIRECTORY
+
+STATUS_OBJECT_NAME_NOT_FOUND = 0xc0000034
+STATUS_OBJECT_NAME_COLLISION = 0xc0000035
+STATUS_OBJECT_PATH_NOT_FOUND = 0xc000003a
+STATUS_FILE_IS_A_DIRECTORY = 0xc00000ba
+STATUS_DIRECTORY_NOT_EMPTY = 0xc0000101
+STATUS_NOT_A_DIRECTORY = 0xc0000103
+
+
+class _Message(object):
+    """ SMB2 reply carrying only a status. """
+
+    def __init__(self, status):
+        self.protocol = 2
+        self.status = status
+
+
+def _failure(status):
+    return OperationFailure('Operation failed', [_Message(status)])
+
+
+class _Node(object):
+    """ File or directory held by the server. """
+
+    def __init__(self, is_dir):
+        self.is_dir = is_dir
+        self.data = bytearray()
+        self.children = {} if is_dir else None
+        self.ctime = self.atime = self.mtime = time.time()
+
+    def touch(self):
+        """ Update the modification time, as a change of entries does. """
+        self.mtime = time.time()
+
+    def info(self, name):
+        attributes = ATTR_DIRECTORY if self.is_dir else ATTR_ARCHIVE
+        return SharedFile(self.ctime, self.atime, self.mtime, self.mtime,
+                          len(self.data), len(self.data), attributes, u'',
+                          name)
+
+
+class FakeSMBServer(object):
+    """ Shares kept in memory, reachable by connecting to `ip`.
+
+        Each request takes at least `latency` seconds, and data is sent at
+        `bandwidth` bytes per second on each connection if given.
+    """
+
+    servers = {}
+
+    def __init__(self, ip, latency=0, bandwidth=None):
+        self.ip = ip
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.lock = threading.RLock()
+        self.shares = {}
+        self.calls = 0
+        FakeSMBServer.servers[ip] = self
+
+    def _split(self, path):
+        return [p for p in path.replace('\\', '/').split('/') if p]
+
+    def lookup(self, share, path):
+        """ Node at a path, failing the way a server does if missing. """
+        node = self.shares.setdefault(share, _Node(True))
+        parts = self._split(path)
+        for ndx, part in enumerate(parts):
+            if not node.is_dir:
+                raise _failure(STATUS_OBJECT_PATH_NOT_FOUND)
+            if part not in node.children:
+                if ndx == len(parts) - 1:
+                    raise _failure(STATUS_OBJECT_NAME_NOT_FOUND)
+                raise _failure(STATUS_OBJECT_PATH_NOT_FOUND)
+            node = node.children[part]
+        return node
+
+    def populate(self, share, path, names, size=0):
+        """ Create files of `size` zero bytes in an existing directory. """
+        with self.lock:
+            node = self.lookup(share, path)
+            for name in names:
+                child = node.children[name] = _Node(False)
+                child.data.extend(b'\0' * size)
+            node.touch()
+
+    def parent(self, share, path):
+        """ Directory node containing a path and the name within it. """
+        parts = self._split(path)
+        try:
+            parent = self.lookup(share, '/'.join(parts[:-1]))
+        except OperationFailure:
+            raise _failure(STATUS_OBJECT_PATH_NOT_FOUND)
+        if not parent.is_dir:
+            raise _failure(STATUS_OBJECT_PATH_NOT_FOUND)
+        return parent, parts[-1]
+
+
+class FakeSMBConnection(object):
+    """ Connection to a FakeSMBServer with the signatures of pysmb. """
+
+    def __init__(self, username, password, my_name, remote_name, domain='',
+                 use_ntlm_v2=True, *args, **kwargs):
+        self.server = None
+
+    def connect(self, ip, port=139, *args, **kwargs):
+        self.server = FakeSMBServer.servers[ip]
+        return True
+
+    def close(self):
+        self.server = None
+
+    def _request(self):
+        if self.server is None:
+            raise NotConnectedError('Not connected to server')
+        with self.server.lock:
+            self.server.calls += 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+    def _send(self, data):
+        """ Take the time `data` needs to cross the link. """
+        if self.server.bandwidth:
+            time.sleep(len(data) / float(self.server.bandwidth))
+
+    def echo(self, data, timeout=10):
+        self._request()
+        return data
+
+    def listPath(self, service_name, path, search=0, pattern='*',
+                 timeout=30):
+        self._request()
+        with self.server.lock:
+            node = self.server.lookup(service_name, path)
+            if not node.is_dir:
+                raise _failure(STATUS_NOT_A_DIRECTORY)
+            entries = [(u'.', node), (u'..', node)]
+            entries.extend(sorted(node.children.items()))
+            return [child.info(name) for name, child in entries
+                    if fnmatch.fnmatchcase(name, pattern)]
+
+    def getAttributes(self, service_name, path, timeout=30):
+        self._request()
+        with self.server.lock:
+            node = self.server.lookup(service_name, path)
+            parts = self.server._split(path)
+            return node.info(parts[-1] if parts else u'')
+
+    def retrieveFile(self, service_name, path, file_obj, timeout=30):
+        return self.retrieveFileFromOffset(service_name, path, file_obj)
+
+    def retrieveFileFromOffset(self, service_name, path, file_obj, offset=0,
+                               max_length=-1, timeout=30):
+        self._request()
+        with self.server.lock:
+            node = self.server.lookup(service_name, path)
+            if node.is_dir:
+                raise _failure(STATUS_FILE_IS_A_DIRECTORY)
+        start = offset
+        while max_length < 0 or offset < start + max_length:
+            end = offset + 65536
+            if max_length >= 0:
+                end = min(end, start + max_length)
+            with self.server.lock:
+                data = bytes(node.data[offset:end])
+            if not data:
+                break
+            self._send(data)
+            file_obj.write(data)
+            offset += len(data)
+        return 0, offset - start
+
+    def storeFile(self, service_name, path, file_obj, timeout=30):
+        return self.storeFileFromOffset(service_name, path, file_obj, 0, True)
+
+    def storeFileFromOffset(self, service_name, path, file_obj, offset=0,
+                            truncate=False, timeout=30):
+        self._request()
+        with self.server.lock:
+            parent, name = self.server.parent(service_name, path)
+            node = parent.children.get(name)
+            if node is None:
+                node = parent.children[name] = _Node(False)
+                parent.touch()
+            elif node.is_dir:
+                raise _failure(STATUS_FILE_IS_A_DIRECTORY)
+            if truncate:
+                del node.data[:]
+        while True:
+            data = file_obj.read(65536)
+            if not data:
+                break
+            self._send(data)
+            with self.server.lock:
+                if len(node.data) < offset:
+                    node.data.extend(b'\0' * (offset - len(node.data)))
+                node.data[offset:offset + len(data)] = data
+                offset += len(data)
+        node.touch()
+        return offset
+
+    def deleteFiles(self, service_name, path_file_pattern,
+                    delete_matching_folders=False, timeout=30):
+        self._request()
+        with self.server.lock:
+            parent, name = self.server.parent(service_name,
+                                              path_file_pattern)
+            if '*' in name or '?' in name:
+                for child in list(parent.children):
+                    if (fnmatch.fnmatchcase(child, name) and
+                            (delete_matching_folders or
+                             not parent.children[child].is_dir)):
+                        del parent.children[child]
+                        parent.touch()
+                return
+            node = self.server.lookup(service_name, path_file_pattern)
+            if node.is_dir and not delete_matching_folders:
+                raise _failure(STATUS_FILE_IS_A_DIRECTORY)
+            del parent.children[name]
+            parent.touch()
+
+    def createDirectory(self, service_name, path, timeout=30):
+        self._request()
+        with self.server.lock:
+            parent, name = self.server.parent(service_name, path)
+            if name in parent.children:
+                raise _failure(STATUS_OBJECT_NAME_COLLISION)
+            parent.children[name] = _Node(True)
+            parent.touch()
+
+    def deleteDirectory(self, service_name, path, timeout=30):
+        self._request()
+        with self.server.lock:
+            node = self.server.lookup(service_name, path)
+            if not node.is_dir:
+                raise _failure(STATUS_NOT_A_DIRECTORY)
+            if node.children:
+                raise _failure(STATUS_DIRECTORY_NOT_EMPTY)
+            parent, name = self.server.parent(service_name, path)
+            del parent.children[name]
+            parent.touch()
+
+    def rename(self, service_name, old_path, new_path, timeout=30):
+        self._request()
+        with self.server.lock:
+            node = self.server.lookup(service_name, old_path)
+            src_parent, src_name = self.server.parent(service_name, old_path)
+            dst_parent, dst_name = self.server.parent(service_name, new_path)
+            if dst_name in dst_parent.children:
+                raise _failure(STATUS_OBJECT_NAME_COLLISION)
+            del src_parent.children[src_name]
+            dst_parent.children[dst_name] = node
+            src_parent.touch()
+            dst_parent.touch()